@@ -62,7 +62,12 @@ local network = {
     last_ping = 0,
     last_move = 0,
     last_sent_position = { x = 0, y = 0 },
-    last_bullet_fired_ts = os.time()
+    last_bullet_fired_ts = os.time(),
+    state_time = nil, -- server timestamp of the state on screen, for lag compensation
+    -- server-side movement: only direction changes are sent, the server moves the tank
+    move_seq = 0,
+    sent_moving = nil, -- direction last sent in a move_input (nil = stopped)
+    move_history = {} -- move_seq -> predicted position when that input was sent
 }
 
 local lobby = {
@@ -163,7 +168,8 @@ function connectToServer(room_id)
     sendNetworkMessage({
         action = "join_room",
         player_id = network.player_id,
-        room_name = room_id
+        room_name = room_id,
+        movement = "server"
     })
 end
 
@@ -197,14 +203,8 @@ function love.update(dt)
         end
     
     
-        -- this is spam, but lets think it is OK :)
-        if lobby.show_lobby == false and network.player_position ~= game_state.players[network.player_id].player_position then
-            sendNetworkMessage({
-                action = "move",
-                player_id = network.player_id,
-                position = network.player_position,
-                direction = network.player_direction
-            })
+        if lobby.show_lobby == false then
+            sendMoveInput()
         end
         
         -- Network receiving
@@ -229,10 +229,54 @@ function love.update(dt)
 
 end
 
+-- Tell the server when the tank starts, stops or turns; it moves the tank itself
+function sendMoveInput()
+    local moving = nil
+    if network.is_alive and (network.player_speed.vx ~= 0 or network.player_speed.vy ~= 0) then
+        moving = network.player_direction
+    end
+    if moving == network.sent_moving then
+        return
+    end
+    network.sent_moving = moving
+    network.move_seq = network.move_seq + 1
+    network.move_history[network.move_seq] = { x = network.player_position.x, y = network.player_position.y }
+    sendNetworkMessage({
+        action = "move_input",
+        player_id = network.player_id,
+        direction = moving,
+        move_seq = network.move_seq
+    })
+end
+
+-- The server says where the tank was when input 'move_seq' took effect;
+-- shift the prediction by the difference from where we thought it was
+function reconcileMove(msg)
+    local sent = network.move_history[msg.move_seq]
+    if sent and msg.position then
+        local dx = msg.position.x - sent.x
+        local dy = msg.position.y - sent.y
+        network.player_position.x = network.player_position.x + dx
+        network.player_position.y = network.player_position.y + dy
+        for seq, pos in pairs(network.move_history) do
+            if seq > msg.move_seq then
+                pos.x = pos.x + dx
+                pos.y = pos.y + dy
+            end
+        end
+    end
+    for seq in pairs(network.move_history) do
+        if seq <= msg.move_seq then
+            network.move_history[seq] = nil
+        end
+    end
+end
+
 function handleNetworkMessage(msg)
     if msg.action == "update_state" then
         -- Print "Update state"
         game_state = msg.game_state
+        network.state_time = msg.timestamp
         -- Check if we are in players, but the waiting_room is empty - this means game started
         if game_state.game_started then
             lobby.show_lobby = false
@@ -256,6 +300,12 @@ function handleNetworkMessage(msg)
         else
             network.is_alive = true
         end
+    elseif msg.action == "move_ack" then
+        reconcileMove(msg)
+    elseif msg.action == "revived" then
+        -- the server picked the spawn point; inputs sent before it no longer apply
+        network.player_position = msg.position
+        network.move_history = {}
     elseif msg.action == "ping" then
         sendNetworkMessage({
             action = "pong",
@@ -396,7 +446,10 @@ function love.keypressed(key)
                 network.last_bullet_fired_ts = os.time()
                 sendNetworkMessage({
                     action = "shoot",
-                    player_id = network.player_id
+                    player_id = network.player_id,
+                    position = network.player_position,
+                    direction = network.player_direction,
+                    state_time = network.state_time
                 }) 
             end
         end
@@ -573,7 +626,6 @@ function love.mousepressed(x, y, button)
                 action = "revive",
                 player_id = network.player_id
             })
-            network.player_position = {x = math.random(100, 700), y = math.random(100, 500)}
         end
     end
 end
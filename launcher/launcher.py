@@ -1,5 +1,5 @@
 import subprocess
-import threading
+import selectors
 import os
 import sys
 import time
@@ -9,8 +9,22 @@ import socket
 SERVER_ADDR = ('10.247.1.236', 9999)
 BUFFER_SIZE = 65536
 LOCAL_ADDR = ('127.0.0.1', 9000)
-shutdown = threading.Event()
-LUA_ADDR = ''
+STATS_INTERVAL = 10   # how often the bridge prints its counters (seconds)
+
+# inputs are bundled and sent at a fixed rate, each one repeated until acked
+INPUT_SEND_RATE  = 30   # input bundles per second
+INPUT_REDUNDANCY = 3    # each input is sent in this many bundles, unless acked sooner
+BUNDLED_ACTIONS  = {'move', 'move_input', 'shoot', 'set_ready', 'start_game', 'revive', 'chat'}
+
+# per-direction counters; latency is the time from receiving a packet to forwarding it
+stats = {
+    'lua->server': {'packets': 0, 'bytes': 0, 'dropped': 0, 'latency_total': 0.0, 'latency_max': 0.0},
+    'server->lua': {'packets': 0, 'bytes': 0, 'dropped': 0, 'latency_total': 0.0, 'latency_max': 0.0},
+}
+input_stats = {'inputs': 0, 'coalesced': 0, 'bundles': 0, 'resent': 0}
+
+# inputs not yet acked by the server: {'seq', 'msg', 'sends', 'received'}
+bundle = {'player_id': None, 'next_seq': 1, 'acked': 0, 'history': []}
 
 # ------------------------------------------------
 # RESOURCE PATH FOR PYINSTALLER
@@ -31,53 +45,158 @@ def start_game():
 
 # ------------------------------------------------
 # BRIDGE LOGIC
-def start_lua_listener(server_socket, lua_socket):
-    def lua_listener():
-        global LUA_ADDR
-        print('[Lua Listener] Waiting for Lua client on', LOCAL_ADDR)
-        try:
-            while not shutdown.is_set():
-                data, addr = lua_socket.recvfrom(BUFFER_SIZE)
-                if not LUA_ADDR:
-                    LUA_ADDR = addr
-                    print('[Lua Listener] Got Lua address:', addr)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    if msg['action'] != 'leave':
-                        server_socket.sendto(json.dumps(msg).encode('utf-8'), SERVER_ADDR)
-                    else:
-                        server_socket.sendto(json.dumps(msg).encode('utf-8'), SERVER_ADDR)
-                        shutdown.set()
-        except Exception as e:
-            print('[Lua Listener] Error:', e)
-    threading.Thread(target=lua_listener, daemon=True).start()
-
-def start_server_listener(server_socket, lua_socket):
-    def server_listener():
-        try:
-            while not shutdown.is_set():
-                if LUA_ADDR == '':
-                    continue
-                data, _ = server_socket.recvfrom(BUFFER_SIZE)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    lua_socket.sendto(json.dumps(msg).encode('utf-8'), LUA_ADDR)
-        except Exception as e:
-            print('[Server Listener] Error:', e)
-    threading.Thread(target=server_listener, daemon=True).start()
+def parse_json(data):
+    # None for binary or malformed packets
+    if data[:1] != b'{':
+        return None
+    try:
+        msg = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return msg if isinstance(msg, dict) else None
+
+def forward(sock, data, addr, direction, received):
+    # send the packet unchanged and count it
+    counters = stats[direction]
+    try:
+        sock.sendto(data, addr)
+    except OSError:
+        counters['dropped'] += 1
+        return
+    latency = time.perf_counter() - received
+    counters['packets'] += 1
+    counters['bytes'] += len(data)
+    counters['latency_total'] += latency
+    counters['latency_max'] = max(counters['latency_max'], latency)
+
+def queue_input(msg, received):
+    # a move that hasn't been sent yet is replaced by the newer one
+    bundle['player_id'] = msg.get('player_id')
+    msg = {key: value for key, value in msg.items() if key != 'player_id'}
+    input_stats['inputs'] += 1
+    if msg.get('action') == 'move':
+        for entry in bundle['history']:
+            if entry['sends'] == 0 and entry['msg'].get('action') == 'move':
+                entry['msg'] = msg
+                input_stats['coalesced'] += 1
+                return
+    bundle['history'].append({'seq': bundle['next_seq'], 'msg': msg, 'sends': 0, 'received': received})
+    bundle['next_seq'] += 1
+
+def send_bundle(server_socket):
+    # every input not acked and not yet sent INPUT_REDUNDANCY times, oldest first
+    history = [entry for entry in bundle['history']
+               if entry['seq'] > bundle['acked'] and entry['sends'] < INPUT_REDUNDANCY]
+    bundle['history'] = history
+    if not history:
+        return
+    inputs   = []
+    received = time.perf_counter()   # oldest new input, for the latency counter
+    for entry in history:
+        if entry['sends']:
+            input_stats['resent'] += 1
+        else:
+            received = min(received, entry['received'])
+        entry['sends'] += 1
+        inputs.append(dict(entry['msg'], seq=entry['seq']))
+    data = json.dumps({
+        'action': 'input_bundle',
+        'player_id': bundle['player_id'],
+        'inputs': inputs,
+    }).encode('utf-8')
+    input_stats['bundles'] += 1
+    forward(server_socket, data, SERVER_ADDR, 'lua->server', received)
+
+def read_input_ack(data):
+    # note the sequence number acked by the server
+    if b'input_ack' not in data:
+        return False
+    msg = parse_json(data)
+    if not msg or msg.get('action') != 'input_ack':
+        return False
+    if isinstance(msg.get('seq'), int):
+        bundle['acked'] = max(bundle['acked'], msg['seq'])
+    return True
+
+def print_stats():
+    for direction, c in stats.items():
+        average = c['latency_total'] / c['packets'] * 1e6 if c['packets'] else 0.0
+        print('[Bridge] %s: %d packets, %d bytes, %d dropped, latency avg %.1f us, max %.1f us'
+              % (direction, c['packets'], c['bytes'], c['dropped'], average, c['latency_max'] * 1e6))
+    print('[Bridge] inputs: %(inputs)d received, %(coalesced)d coalesced, '
+          '%(bundles)d bundles, %(resent)d resent' % input_stats)
+
+def relay(server_socket, lua_socket):
+    # one thread, blocked in select() until a socket is readable or a bundle is due
+    lua_addr = None
+    selector = selectors.DefaultSelector()
+    selector.register(lua_socket, selectors.EVENT_READ, 'lua')
+    selector.register(server_socket, selectors.EVENT_READ, 'server')
+    print('[Bridge] Waiting for Lua client on', LOCAL_ADDR)
+
+    bundle_interval = 1.0 / INPUT_SEND_RATE
+    next_bundle = time.monotonic()
+    next_stats  = time.monotonic() + STATS_INTERVAL
+    running = True
+    while running:
+        wake = min(next_stats, next_bundle) if bundle['history'] else next_stats
+        for key, _ in selector.select(timeout=max(0.0, wake - time.monotonic())):
+            while running:
+                try:
+                    data, addr = key.fileobj.recvfrom(BUFFER_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionError:
+                    continue   # an earlier send bounced (Windows); skip it
+                received = time.perf_counter()
+
+                if key.data == 'lua':
+                    if addr != lua_addr:
+                        lua_addr = addr
+                        print('[Bridge] Got Lua address:', addr)
+                    msg = parse_json(data)
+                    action = msg.get('action') if msg else None
+                    if action in BUNDLED_ACTIONS:
+                        if not bundle['history']:
+                            next_bundle = max(next_bundle, time.monotonic())
+                        queue_input(msg, received)
+                        continue
+                    # inputs queued before this packet go first
+                    if any(entry['sends'] == 0 for entry in bundle['history']):
+                        send_bundle(server_socket)
+                    forward(server_socket, data, SERVER_ADDR, 'lua->server', received)
+                    if action == 'leave':
+                        running = False
+                elif read_input_ack(data):
+                    pass
+                elif lua_addr is None:
+                    stats['server->lua']['dropped'] += 1
+                else:
+                    forward(lua_socket, data, lua_addr, 'server->lua', received)
+
+        now = time.monotonic()
+        if bundle['history'] and now >= next_bundle:
+            send_bundle(server_socket)
+            next_bundle = max(next_bundle + bundle_interval, now)
+        if now >= next_stats:
+            print_stats()
+            next_stats = now + STATS_INTERVAL
+    selector.close()
 
 def run_bridge():
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.settimeout(1.0)
+    server_socket.setblocking(False)
+    server_socket.bind(('0.0.0.0', 0))   # an unbound socket can't be selected on Windows
     lua_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    lua_socket.setblocking(False)
     lua_socket.bind(LOCAL_ADDR)
 
-    start_lua_listener(server_socket, lua_socket)
-    start_server_listener(server_socket, lua_socket)
-
-    while not shutdown.is_set():
-        time.sleep(0.1)
+    try:
+        relay(server_socket, lua_socket)
+    except KeyboardInterrupt:
+        pass
 
+    print_stats()
     server_socket.close()
     lua_socket.close()
     print('[Bridge] Shutting down.')
@@ -0,0 +1,162 @@
+"""
+Benchmark harness: start a server on loopback, load it with bots, and
+report tick timings, traffic and server CPU/RSS, optionally against a
+baseline file.
+
+    python bench.py --players 200 --rooms 10 --duration 30 --save-baseline baseline.json
+    python bench.py --players 200 --rooms 10 --duration 30 --baseline baseline.json
+
+Exits with status 1 when a metric is worse than the baseline by more
+than --tolerance.
+"""
+import asyncio        # runs the bots
+import json           # log records and result files
+import os             # server script path
+import resource       # CPU time and peak RSS of the server process
+import signal         # stopping the server
+import socket         # picking a free port
+import statistics     # medians over log intervals
+import subprocess     # the server under test
+import sys            # interpreter path, exit status
+import threading      # reads the server log while the bots run
+import time           # wall clock of the run
+import argparse       # command line options
+
+import bot            # headless clients
+
+SERVER_SCRIPT  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+STATS_INTERVAL = 1.0   # seconds between the server's tick_stats records during a run
+START_TIMEOUT  = 5.0   # how long to wait for the server to start listening (seconds)
+
+# metric -> which way is better; these are compared against the baseline
+METRICS = {
+    'tick_rate':       'higher',
+    'tick_p50_ms':     'lower',
+    'tick_p90_ms':     'lower',
+    'tick_p99_ms':     'lower',
+    'overruns':        'lower',
+    'bytes_out_per_s': 'lower',   # server -> clients, as received by the bots
+    'cpu_percent':     'lower',
+    'max_rss_mb':      'lower',
+}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_log(stream, records, listening):
+    """
+    Collect the server's tick_stats records (runs in a thread).
+    """
+    for line in stream:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('event') == 'listening':
+            listening.set()
+        elif record.get('event') == 'tick_stats':
+            records.append(record)
+
+
+def summarize(records, stats, usage, wall, warmup):
+    """
+    Turn the tick_stats records of one run (minus the first 'warmup'
+    intervals) and the bots' counters into the benchmark metrics.
+    """
+    records = records[warmup:] or records
+    timed   = [r for r in records if r.get('percentiles_ms')]
+    elapsed = stats['elapsed'] or 1.0
+    return {
+        'tick_rate':       round(statistics.mean(r['rate'] for r in records), 2) if records else 0.0,
+        'tick_p50_ms':     round(statistics.median(r['percentiles_ms']['50'] for r in timed), 3) if timed else None,
+        'tick_p90_ms':     round(statistics.median(r['percentiles_ms']['90'] for r in timed), 3) if timed else None,
+        'tick_p99_ms':     round(max(r['percentiles_ms']['99'] for r in timed), 3) if timed else None,
+        'overruns':        records[-1]['overruns'] - records[0]['overruns'] if records else 0,
+        'bytes_out_per_s': round(stats['bytes_in'] / elapsed),
+        'bytes_in_per_s':  round(stats['bytes_out'] / elapsed),
+        'updates_per_s':   round(stats['updates'] / elapsed, 1),
+        'cpu_percent':     round((usage.ru_utime + usage.ru_stime) / wall * 100, 1),
+        'max_rss_mb':      round(usage.ru_maxrss / 1024, 1),   # kilobytes on Linux
+        'players_joined':  stats['joined'],
+        'join_failures':   stats['join_failures'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print each metric next to its baseline value. Returns the metrics
+    that got worse by more than 'tolerance' (a fraction).
+    """
+    regressions = []
+    print('%-16s %12s %12s %9s' % ('metric', 'baseline', 'current', 'change'))
+    for name, better in METRICS.items():
+        base, current = baseline.get(name), results.get(name)
+        if base is None or current is None:
+            continue
+        if base:
+            change = (current - base) / base
+        else:
+            change = float('inf') if current > base else 0.0   # e.g. overruns going up from none
+        worse  = change > tolerance if better == 'lower' else change < -tolerance
+        if worse:
+            regressions.append(name)
+        print('%-16s %12s %12s %+8.1f%%%s' % (name, base, current, change * 100, '  WORSE' if worse else ''))
+    return regressions
+
+
+def run(options):
+    """
+    One benchmark run: server up, bots for options.duration, server down.
+    """
+    options.host, options.port = '127.0.0.1', free_port()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+    server = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--host', options.host, '--port', str(options.port),
+         '--workers', str(options.workers), '--stats-interval', str(STATS_INTERVAL)],
+        stdout=subprocess.PIPE, text=True)
+    records, listening = [], threading.Event()
+    reader = threading.Thread(target=read_log, args=(server.stdout, records, listening), daemon=True)
+    reader.start()
+    try:
+        if not listening.wait(START_TIMEOUT):
+            raise RuntimeError('server did not start')
+        stats = asyncio.run(bot.run_bots(options))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        reader.join(1.0)
+    wall  = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = resource.struct_rusage((
+        after.ru_utime - before.ru_utime, after.ru_stime - before.ru_stime, after.ru_maxrss,
+    ) + tuple(after)[3:])
+    return summarize(records, stats, usage, wall, options.warmup)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Tetanki server with headless bots')
+    bot.add_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--warmup', type=int, default=2, help='tick_stats intervals to ignore at the start')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed relative change before a metric counts as a regression')
+    options = parser.parse_args()
+
+    results = run(options)
+    print(json.dumps(results, indent=2))
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print('regressions: ' + ', '.join(regressions))
+            sys.exit(1)
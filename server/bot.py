@@ -0,0 +1,269 @@
+"""
+Headless bots for load testing the game server.
+
+Each bot has its own UDP socket (the server keys players by address) and
+speaks the same JSON messages the Lua client sends through the bridge:
+join_room, set_ready, start_game, move, shoot, revive, pong and leave,
+optionally wrapped in input_bundle like the bridge does. With
+--server-movement they send move_input on each turn instead of a move
+per step.
+
+    python bot.py --host 127.0.0.1 --port 9999 --players 200 --rooms 10
+"""
+import asyncio        # event loop and UDP endpoints
+import json           # message encoding
+import random         # movement and shooting patterns
+import re             # cheap field extraction from large state updates
+import time           # rates and timestamps
+import argparse       # command line options
+
+# ------------------------
+# Bot behaviour parameters
+# ------------------------
+TANK_SPEED      = 200     # pixels per second, as in the Lua client
+MAP_WIDTH       = 800
+MAP_HEIGHT      = 600
+TURN_INTERVAL   = 1.0     # mean time between direction changes (seconds)
+REVIVE_DELAY    = 1.0     # how long a destroyed bot waits before reviving (seconds)
+START_RETRY     = 1.0     # how often a room's first bot retries start_game (seconds)
+INPUT_REDUNDANCY = 3      # with --bundle: bundles an input is repeated in, unless acked
+DIRECTIONS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+
+SEQ_PATTERN   = re.compile(rb'"seq": (\d+)')
+START_PATTERN = re.compile(rb'"game_started": (true|false)')
+
+
+# ---------------------------------------
+# One bot: a UDP endpoint plus its state
+# ---------------------------------------
+class BotProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bot, stats):
+        self.bot   = bot
+        self.stats = stats
+
+    def connection_made(self, transport):
+        self.bot['transport'] = transport
+
+    def datagram_received(self, data, addr):
+        self.stats['packets_in'] += 1
+        self.stats['bytes_in'] += len(data)
+        handle_server_message(self.bot, data, self.stats)
+
+    def error_received(self, exc):
+        self.stats['errors'] += 1
+
+
+def new_bot(index, room_name, options):
+    return {
+        'player_id': 'bot_%d' % index,
+        'room_name': room_name,
+        'leader': False,            # first bot of its room: creates and starts it
+        'transport': None,
+        'joined': False,
+        'game_started': False,
+        'alive': True,
+        'dead_since': None,
+        'position': {'x': random.uniform(100, 700), 'y': random.uniform(100, 500)},
+        'direction': random.choice(list(DIRECTIONS)),
+        'next_turn': 0.0,
+        'next_shot': 0.0,
+        'last_start': 0.0,
+        'state_time': None,         # timestamp of the latest full state (lag compensation)
+        'delta': options.delta,
+        'bundle': options.bundle,
+        'server_movement': options.server_movement,
+        'move_seq': 0,
+        'input_seq': 0,
+        'unacked': [],              # [input, sends] for --bundle
+    }
+
+
+def send(bot, msg, stats):
+    msg['player_id'] = bot['player_id']
+    data = json.dumps(msg).encode('utf-8')
+    bot['transport'].sendto(data)
+    stats['packets_out'] += 1
+    stats['bytes_out'] += len(data)
+
+
+def send_input(bot, msg, stats):
+    """
+    Send an in-room input directly, or as the bridge does: numbered, in
+    an input_bundle that repeats recent unacked inputs.
+    """
+    if not bot['bundle']:
+        send(bot, msg, stats)
+        return
+    bot['input_seq'] += 1
+    bot['unacked'].append([dict(msg, seq=bot['input_seq']), 0])
+    bot['unacked'] = [entry for entry in bot['unacked'] if entry[1] < INPUT_REDUNDANCY]
+    for entry in bot['unacked']:
+        entry[1] += 1
+    send(bot, {'action': 'input_bundle', 'inputs': [entry[0] for entry in bot['unacked']]}, stats)
+
+
+def handle_server_message(bot, data, stats):
+    """
+    React to a server packet. State updates are large and frequent, so
+    they are only scanned with regexes, never decoded in full.
+    """
+    if data.startswith(b'{"action": "update_'):
+        stats['updates'] += 1
+        seq = SEQ_PATTERN.search(data)
+        if bot['delta'] and seq:
+            send(bot, {'action': 'ack', 'seq': int(seq.group(1))}, stats)
+        if data.startswith(b'{"action": "update_state"'):
+            bot['state_time'] = time.time()
+            started = START_PATTERN.search(data)
+            if started:
+                bot['game_started'] = started.group(1) == b'true'
+        # our own hp, without decoding the whole state
+        marker = data.find(b'"%s": {' % bot['player_id'].encode())
+        if marker >= 0:
+            hp = re.search(rb'"hp": (-?\d+)', data[marker:marker + 200])
+            if hp:
+                bot['alive'] = int(hp.group(1)) > 0
+        return
+
+    try:
+        msg = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        stats['errors'] += 1
+        return
+    action = msg.get('action')
+    if action == 'ping':
+        send(bot, {'action': 'pong'}, stats)
+    elif action == 'join_room_response':
+        if msg.get('success'):
+            bot['joined'] = True
+            send(bot, {'action': 'set_ready'}, stats)
+        else:
+            stats['join_failures'] += 1
+    elif action == 'move_ack':
+        bot['position'] = msg.get('position') or bot['position']
+    elif action == 'revived':
+        bot['position'] = msg.get('position') or bot['position']
+    elif action == 'input_ack':
+        bot['unacked'] = [entry for entry in bot['unacked'] if entry[0]['seq'] > msg.get('seq', 0)]
+
+
+# --------------------------
+# Driving all bots at a rate
+# --------------------------
+def step_bot(bot, now, dt, options, stats):
+    """
+    One movement step for one bot: maybe turn, move, shoot or revive.
+    """
+    if not bot['joined']:
+        return
+    if bot['leader'] and not bot['game_started'] and now - bot['last_start'] >= START_RETRY:
+        bot['last_start'] = now
+        send(bot, {'action': 'start_game'}, stats)
+    if not bot['alive']:
+        if bot['dead_since'] is None:
+            bot['dead_since'] = now
+        elif now - bot['dead_since'] >= REVIVE_DELAY:
+            bot['dead_since'] = None
+            bot['alive'] = True
+            send_input(bot, {'action': 'revive'}, stats)
+            bot['next_turn'] = now   # a destroyed tank stopped; drive off again
+        return
+
+    turned = now >= bot['next_turn']
+    if turned:
+        bot['direction'] = random.choice(list(DIRECTIONS))
+        bot['next_turn'] = now + random.expovariate(1.0 / TURN_INTERVAL)
+    dx, dy = DIRECTIONS[bot['direction']]
+    pos = bot['position']
+    pos['x'] = max(0, min(MAP_WIDTH, pos['x'] + dx * TANK_SPEED * dt))
+    pos['y'] = max(0, min(MAP_HEIGHT, pos['y'] + dy * TANK_SPEED * dt))
+    if not bot['server_movement']:
+        send_input(bot, {'action': 'move', 'position': dict(pos), 'direction': bot['direction']}, stats)
+    elif turned:
+        bot['move_seq'] += 1
+        send_input(bot, {'action': 'move_input', 'direction': bot['direction'], 'move_seq': bot['move_seq']}, stats)
+
+    if options.shoot_rate > 0 and now >= bot['next_shot']:
+        bot['next_shot'] = now + random.expovariate(options.shoot_rate)
+        shot = {'action': 'shoot', 'position': dict(pos), 'direction': bot['direction']}
+        if bot['state_time'] is not None:
+            shot['state_time'] = bot['state_time']
+        send_input(bot, shot, stats)
+
+
+async def run_bots(options, stats=None):
+    """
+    Connect options.players bots spread over options.rooms rooms, play for
+    options.duration seconds, then leave. Returns the traffic counters.
+    """
+    if stats is None:
+        stats = new_stats()
+    loop = asyncio.get_running_loop()
+    room_names = ['bench_%d' % (i + 1) for i in range(options.rooms)]
+    bots = [new_bot(i, room_names[i % options.rooms], options) for i in range(options.players)]
+    for bot in bots:
+        await loop.create_datagram_endpoint(lambda bot=bot: BotProtocol(bot, stats),
+                                            remote_addr=(options.host, options.port))
+
+    # the first bot of each room creates it; everybody joins a moment later
+    for bot in bots[:options.rooms]:
+        bot['leader'] = True
+        send(bot, {'action': 'create_room', 'room_name': bot['room_name']}, stats)
+    await asyncio.sleep(0.5)
+    for i, bot in enumerate(bots):
+        send(bot, {'action': 'join_room', 'room_name': bot['room_name'], 'delta': bot['delta'],
+                   'movement': 'server' if bot['server_movement'] else 'client'}, stats)
+        if i % 50 == 49:
+            await asyncio.sleep(0.01)   # don't overflow the server's receive buffer
+
+    step     = 1.0 / options.move_rate
+    started  = time.monotonic()
+    previous = started
+    next_step = started
+    while time.monotonic() - started < options.duration:
+        now = time.monotonic()
+        for bot in bots:
+            step_bot(bot, now, now - previous, options, stats)
+        previous = now
+        next_step += step
+        await asyncio.sleep(max(0.0, next_step - time.monotonic()))
+
+    for bot in bots:
+        if bot['joined']:
+            send(bot, {'action': 'leave'}, stats)
+    await asyncio.sleep(0.1)
+    for bot in bots:
+        bot['transport'].close()
+    stats['joined'] = sum(bot['joined'] for bot in bots)
+    stats['elapsed'] = time.monotonic() - started
+    return stats
+
+
+def new_stats():
+    return {'packets_out': 0, 'bytes_out': 0, 'packets_in': 0, 'bytes_in': 0,
+            'updates': 0, 'errors': 0, 'join_failures': 0, 'joined': 0, 'elapsed': 0.0}
+
+
+def add_arguments(parser):
+    parser.add_argument('--host', default='127.0.0.1', help='server address')
+    parser.add_argument('--port', type=int, default=9999, help='server UDP port')
+    parser.add_argument('--players', type=int, default=100, help='number of bots')
+    parser.add_argument('--rooms', type=int, default=10, help='rooms the bots are spread over')
+    parser.add_argument('--move-rate', type=float, default=30, help='moves per second per bot')
+    parser.add_argument('--shoot-rate', type=float, default=1, help='shots per second per bot')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of play')
+    parser.add_argument('--delta', action='store_true', help='ask for delta updates and ack them')
+    parser.add_argument('--bundle', action='store_true', help='send inputs in input_bundle like the bridge')
+    parser.add_argument('--server-movement', action='store_true',
+                        help='send move_input on turns and let the server move the tanks')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless Tetanki bots')
+    add_arguments(parser)
+    options = parser.parse_args()
+    result = asyncio.run(run_bots(options))
+    elapsed = result['elapsed'] or 1.0
+    print(json.dumps({**result,
+                      'bytes_in_per_s': round(result['bytes_in'] / elapsed),
+                      'bytes_out_per_s': round(result['bytes_out'] / elapsed)}))
@@ -3,6 +3,31 @@ import json           # for JSON serialization/deserialization
 import time           # for timestamps and sleeping
 import math           # for distance calculation (hit detection)
 import random         # for assignment of player positions
+import itertools      # for filtering bullet lists by mask
+import queue          # bounded queue between the event loop and the log writer
+import signal         # SIGUSR1 triggers a full state dump
+import sys            # log output stream
+import threading      # background log writer
+import argparse       # command line options
+import multiprocessing  # worker processes when sharding rooms
+import socket         # sockets shared with worker processes
+import struct         # framing of datagrams forwarded to workers
+import zlib           # checksum of the game state in recordings
+import os             # parent process checks in workers
+import collections    # per-room ring buffer of past tank positions
+import heapq          # wakeup times of dormant rooms
+import urllib.parse   # query string of metrics endpoint requests
+import ctypes         # sendmmsg(2) for batched sends on Linux
+import errno          # send errors in the batched egress
+import pickle         # game state snapshot for a hot restart
+import subprocess     # the new server process of a hot restart
+
+import wire           # compact binary protocol (opt-in per client)
+
+try:
+    import numpy as np    # optional: vectorized bullet engine for large rooms
+except ImportError:
+    np = None
 
 # ----------------------------------------
 # World parameters (game map and bullets)
@@ -13,369 +38,2382 @@ BULLET_LIFETIME = 3.0     # how long a bullet lives (seconds) before disappearin
 BULLET_SPEED    = 700     # bullet speed (pixels per second)
 PLAYER_RADIUS   = 20      # approximate radius of a tank (for hit detection)
 BULLET_DAMAGE   = 25      # how much HP a bullet removes on hit
+TANK_SPEED      = 200     # tank speed (pixels per second) for clients with server-side movement
+GRID_CELL_SIZE  = 64      # spatial grid cell size for collision broad-phase (>= 2*PLAYER_RADIUS)
+USE_NUMPY         = True  # use the NumPy bullet engine when NumPy is installed
+NUMPY_MIN_BULLETS = 256   # rooms with fewer bullets use the plain loop (less overhead)
+
+# unit vectors for each facing direction (anything unknown flies right)
+DIRECTIONS = {
+    'up':    (0, -1),
+    'down':  (0,  1),
+    'left':  (-1, 0),
+    'right': (1,  0),
+}
+
+# ------------------------------------------------------------
+# Lag compensation: shots are resolved against past tank positions
+# ------------------------------------------------------------
+MAX_REWIND = 0.2               # furthest a shot is rewound into the past (seconds)
+REWIND_HISTORY_TICKS = 14      # ticks of tank positions kept per room (> MAX_REWIND * TICK_RATE)
+SHOT_POSITION_TOLERANCE = 50   # how far a shot's reported position may be from the server's copy
+STATE_TIME_TOLERANCE = 5.0     # a shot's 'state_time' further than this from now is ignored (seconds)
+
+# ------------------------
+# Server timing parameters
+# ------------------------
+TICK_RATE     = 60        # how many game updates per second
+SEND_RATE     = 60        # default state broadcasts per second for a room (at most TICK_RATE)
+STATE_REFRESH_INTERVAL = 1.0  # resend the state of an unchanged room this often (seconds), in case an update was lost
+MAX_CATCHUP_TICKS = 5     # ticks run back-to-back after a stall; older missed ticks are dropped
+TICK_STATS_INTERVAL = 60  # how often a tick timing summary is logged (seconds)
+PING_INTERVAL = 10        # how often each player is pinged (seconds)
+PONG_TIMEOUT  = 30        # how long a player may stay silent before disconnecting (seconds)
+HEARTBEAT_SLOTS = 100     # timer wheel slots per PING_INTERVAL; pings are spread over them
+RTT_SMOOTHING   = 0.125   # weight of a new round-trip sample in the smoothed RTT
+
+# ---------------------------------------------
+# Snapshot parameters (delta-compressed updates)
+# ---------------------------------------------
+KEYFRAME_INTERVAL    = 60   # send a full keyframe to delta clients at least every N snapshots
+MAX_PENDING_SNAPSHOTS = 64  # unacknowledged snapshots remembered per delta client
+
+# player and bullet fields that are sent to clients (address, wire, rewind, etc. stay on the server)
+PUBLIC_PLAYER_FIELDS = ('ready', 'position', 'direction', 'hp', 'skin')
+PUBLIC_BULLET_FIELDS = ('id', 'player_id', 'origin', 'direction', 'created')
+
+# Interest management, for maps much larger than the screen: a player gets
+# the tanks and bullets within one INTEREST_CELL_SIZE cell of its own in
+# every update, and the rest of the room only every FAR_UPDATE_EVERY updates
+INTEREST_CELL_SIZE = None   # pixels; None = everyone gets the whole room every update
+FAR_UPDATE_EVERY   = 4
+
+
+# ---------------
+# Room management
+# ---------------
+DEFAULT_ROOMS         = ('room_1', 'room_2', 'room_3')  # always open, never cleaned up
+MAX_ROOMS             = 1000  # per process
+MAX_ROOM_NAME_LENGTH  = 32
+EMPTY_ROOM_TIMEOUT    = 60    # close created rooms that have had no players this long (seconds)
+ROOM_CLEANUP_INTERVAL = 10    # how often empty rooms are looked for (seconds)
+
+# ----------------
+# Input ingestion
+# ----------------
+INPUT_QUEUE_SIZE  = 1024               # inputs queued per room between ticks; more are dropped
+IMMEDIATE_ACTIONS = {'pong', 'ack', 'input_bundle'}   # handled on arrival, not at the next tick
+MAX_BUNDLE_INPUTS = 32                 # inputs read from one input_bundle
+# lobby/lifecycle changes are broadcast right away; other changes wait for the room's next send
+IMMEDIATE_BROADCASTS = {'join_room', 'start_game', 'leave'}
+
+# ----------------------------------------------------
+# Traffic limits: per address, per player and per room
+# ----------------------------------------------------
+MAX_DATAGRAM_SIZE      = 4096   # larger datagrams are dropped before decoding
+MAX_PLAYER_ID_LENGTH   = 64
+MAX_CHAT_LENGTH        = 256    # longer chat messages are cut
+MAX_PLAYERS_PER_ROOM   = 32
+MAX_BULLETS_PER_PLAYER = 16     # bullets in flight per player; further shots are ignored
+MAX_TRACKED_ADDRESSES  = 10000  # addresses with rate limit state; the least recently active are forgotten
+RATE_LIMIT_IDLE        = 60     # forget an address's rate limit state after this long without traffic (seconds)
+RATE_LIMITS = {                 # token bucket per address and action class: (tokens per second, burst)
+    'input':   (300, 300),      # move, move_input, input_bundle, ack
+    'shoot':   (10, 10),
+    'chat':    (2, 5),
+    'room':    (2, 10),         # join_room, create_room, list_rooms, close_room
+    'control': (30, 60),        # everything else (pong, set_ready, leave, ...)
+}
+ACTION_CLASSES = {
+    'move': 'input', 'move_input': 'input', 'input_bundle': 'input', 'ack': 'input', 'shoot': 'shoot', 'chat': 'chat',
+    'join_room': 'room', 'create_room': 'room', 'list_rooms': 'room', 'close_room': 'room',
+}
+
+# -------------------
+# Logging parameters
+# -------------------
+LOG_LEVEL      = 'info'   # lowest level written: debug, info, warning or error
+LOG_QUEUE_SIZE = 10000    # records waiting for the writer; more are dropped (and counted)
+LOG_SAMPLE_EVERY = {      # write only 1 of every N records of these high-frequency events
+    'move': 60,
+}
+
+# tick duration histogram bucket upper bounds (milliseconds)
+TICK_HISTOGRAM_BUCKETS = (0.5, 1, 2, 4, 8, 16, 33, 66, 133)
+
+# ------------------------------
+# Metrics endpoint and profiling
+# ------------------------------
+METRICS_HOST        = '127.0.0.1'  # the endpoint is only reachable from this machine
+METRICS_PORT        = 0       # HTTP port for /metrics (0 = off); workers use METRICS_PORT + 1 + index
+LOOP_LAG_INTERVAL   = 0.1     # how often event loop lag is measured (seconds)
+PROFILE_INTERVAL    = 0.005   # sampling profiler period (seconds)
+PROFILE_SECONDS     = 10      # default profile length (SIGUSR2, /profile)
+PROFILE_MAX_SECONDS = 300
+PROFILE_DIR         = '.'     # where profiles are written
+
+# -------------------------
+# Egress (outgoing packets)
+# -------------------------
+USE_SENDMMSG       = True   # flush with sendmmsg(2) where available (Linux); otherwise one sendto each
+EGRESS_BATCH       = 1024   # datagrams per sendmmsg call (the kernel's UIO_MAXIOV)
+EGRESS_QUEUE_LIMIT = 64     # datagrams queued per recipient between flushes; the oldest are dropped
+
+# ---------------------------------
+# Match recording (--record FILE)
+# ---------------------------------
+RECORD_PATH          = None               # record every match to this file (None = off)
+RECORD_SEGMENT_BYTES = 64 * 1024 * 1024   # a recording continues in FILE.1, FILE.2, ... past this size
+RECORD_MAX_SEGMENTS  = 16                 # recording stops (with a warning) after this many segments
+RECORD_BUFFER_BYTES  = 1024 * 1024        # records are written to the file in chunks this large
+
+# ---------------------------
+# Hot restart (kill -HUP <pid>)
+# ---------------------------
+RESTART_TIMEOUT = 10   # how long the old process waits for the new one to take over (seconds)
+
+# ------------------------------------------------------------------
+# Game clock and random numbers. Game logic reads the time from
+# 'clock' and draws from 'rng', never from time/random directly, so a
+# recorded match replays exactly (see the recording section).
+# ------------------------------------------------------------------
+class Clock:
+    """
+    The system clocks, unless pinned: to the tick's time while a tick
+    runs, to the arrival time while a datagram is handled, and to the
+    recorded times during a replay.
+    """
+    def __init__(self):
+        self.pinned = None   # (wall, monotonic) while pinned
+
+    def time(self):
+        return time.time() if self.pinned is None else self.pinned[0]
+
+    def monotonic(self):
+        return time.monotonic() if self.pinned is None else self.pinned[1]
+
+    def pin(self, wall, mono):
+        self.pinned = (wall, mono)
+
+    def unpin(self):
+        self.pinned = None
+
+
+clock = Clock()
+rng   = random.Random()   # spawn points and skins; seeded when recording
+
+# ----------------------------------------
+# Rooms: the defaults plus any that players create
+# ----------------------------------------
+room_nums = itertools.count(1)   # numeric room ids used by the binary protocol
+
+
+def create_room(name, owner=None, send_rate=SEND_RATE):
+    return {
+        'name': name,
+        'num': next(room_nums),
+        'owner': owner,         # player who created the room; None for default rooms
+        'empty_since': None,    # when the room was last seen empty (cleanup)
+        'waiting_room': [],
+        'players': {},
+        'bullets': [],
+        'game_started': False,
+        'snapshot_seq': 0,      # sequence number of the last snapshot sent
+        'send_rate': send_rate, # state broadcasts per second
+        'dirty': False,         # state changed since the last broadcast
+        'last_sent': 0,         # tick of the last broadcast
+        'next_bullet_id': 1,    # ids let delta clients track bullets across snapshots
+        'events': [],           # hit events since the last broadcast
+        'grid': {},             # (cx, cy) -> set of player ids in that grid cell
+        'bullet_arrays': None,  # BulletArrays mirror of 'bullets' (NumPy engine only)
+        'inputs': [],           # (addr, msg) received since the last tick, applied in order
+        'pending_moves': {},    # player_id -> index in 'inputs' of that player's queued move
+        'history': collections.deque(maxlen=REWIND_HISTORY_TICKS),   # [tick time, {pid: (x, y)}, grid]
+        'moving': set(),        # players with server-side movement that are driving
+        'move_acks': {},        # player_id -> move_input seq to acknowledge after this tick's inputs
+        'wake_at': None,        # tick of this room's entry in room_wakeups, if any
+    }
+
+rooms = {}
+for _name in DEFAULT_ROOMS:
+    rooms[_name] = create_room(_name)
+
+# Only active rooms are visited by game_tick. A room goes dormant when it
+# has no inputs, bullets or unsent changes; a dormant room with players
+# is woken again for its next STATE_REFRESH_INTERVAL resend.
+active_rooms = {}   # room id -> room
+room_wakeups = []   # heap of (tick, room id) for dormant rooms
+
+
+def wake_room(room):
+    """
+    Make game_tick visit 'room' from the next tick on.
+    """
+    if room['name'] not in active_rooms and rooms.get(room['name']) is room:
+        active_rooms[room['name']] = room
+
+
+def sleep_room(room, wake_tick=None):
+    """
+    Stop ticking 'room'; with 'wake_tick', wake it up again at that tick.
+    """
+    active_rooms.pop(room['name'], None)
+    if wake_tick is not None and room['wake_at'] is None:
+        room['wake_at'] = wake_tick
+        heapq.heappush(room_wakeups, (wake_tick, room['name']))
+
+
+def wake_due_rooms(tick):
+    """
+    Wake the dormant rooms whose wakeup tick has come.
+    """
+    while room_wakeups and room_wakeups[0][0] <= tick:
+        wake_tick, room_id = heapq.heappop(room_wakeups)
+        room = rooms.get(room_id)
+        if room is not None and room['wake_at'] == wake_tick:
+            room['wake_at'] = None
+            wake_room(room)
+
+# ---------------------------------------------------------------
+# Structured event log: JSON lines written by a background thread
+# ---------------------------------------------------------------
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+log_queue   = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_stats   = {'written': 0, 'dropped': 0, 'sampled_out': 0}
+log_samples = {}   # event -> number of records seen, for LOG_SAMPLE_EVERY
+
+
+def log_event(event, level='info', room=None, player=None, **fields):
+    """
+    Queue one structured log record. Never blocks the event loop: if the
+    writer can't keep up the record is dropped and counted instead.
+    Field values must not be mutated later (pass copies of dicts).
+    """
+    if LOG_LEVELS[level] < LOG_LEVELS[LOG_LEVEL]:
+        return
+    every = LOG_SAMPLE_EVERY.get(event)
+    if every:
+        seen = log_samples.get(event, 0)
+        log_samples[event] = seen + 1
+        if seen % every:
+            log_stats['sampled_out'] += 1
+            return
+    record = {'ts': time.time(), 'level': level, 'event': event, 'tick': current_tick}
+    if shard_count > 1:
+        record['worker'] = shard_index
+    if room is not None:
+        record['room'] = room
+    if player is not None:
+        record['player'] = player
+    record.update(fields)
+    try:
+        log_queue.put_nowait(record)
+    except queue.Full:
+        log_stats['dropped'] += 1
+
+
+def log_writer(stream):
+    """
+    Background thread: serialize queued records and write them to
+    'stream', one JSON object per line. A None record stops the thread.
+    """
+    while True:
+        record = log_queue.get()
+        if record is None:
+            break
+        # records may arrive pre-encoded (see dump_state)
+        line = record if isinstance(record, str) else json.dumps(record, ensure_ascii=False)
+        stream.write(line + '\n')
+        log_stats['written'] += 1
+        if log_queue.empty():
+            stream.flush()
+    stream.flush()
+
+
+def start_log_writer(stream=None):
+    thread = threading.Thread(target=log_writer, args=(stream or sys.stdout,), daemon=True)
+    thread.start()
+    return thread
+
+
+def dump_state(reason='requested'):
+    """
+    Log the entire server state (without delta/grid/engine bookkeeping).
+    The record is encoded here, on the event loop, so the writer thread
+    never reads live game state.
+    """
+    state = {
+        rn: {**{k: v for k, v in room.items() if k not in ('grid', 'bullet_arrays', 'history', 'moving')}, 'players': {
+            pid: {k: v for k, v in info.items() if k not in ('baseline', 'pending', 'cell', 'last_view')}
+            for pid, info in room['players'].items()
+        }}
+        for rn, room in rooms.items()
+    }
+    record = {'ts': time.time(), 'level': 'info', 'event': 'state_dump',
+              'tick': current_tick, 'reason': reason, 'state': state}
+    try:
+        log_queue.put_nowait(json.dumps(record, ensure_ascii=False))
+    except queue.Full:
+        log_stats['dropped'] += 1
+
+
+# ----------------------------------------------------------------
+# Metrics: counters and histograms served in the Prometheus text
+# format on a local HTTP port, and an on-demand sampling profiler
+# ----------------------------------------------------------------
+PHASE_BUCKETS = tuple(ms / 1000 for ms in TICK_HISTOGRAM_BUCKETS)   # seconds
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, EGRESS_QUEUE_LIMIT)           # datagrams
+TICK_PHASES   = ('input', 'simulation', 'collision', 'serialization', 'send')
+
+metrics = {
+    'packets_in':     collections.Counter(),   # action -> datagrams received
+    'bytes_in':       collections.Counter(),   # action -> bytes received
+    'packets_out':    collections.Counter(),   # action -> datagrams sent
+    'bytes_out':      collections.Counter(),   # action -> bytes sent
+    'room_bytes_out': collections.Counter(),   # room -> bytes of state updates sent
+    'room_seconds':   collections.Counter(),   # room -> time spent on its inputs, simulation and broadcasts
+}
+tick_phases = dict.fromkeys(TICK_PHASES, 0.0)  # seconds spent per phase in the current wakeup
+profiler    = {'thread': None}                 # the running stack sampler, if any
+
+
+def new_histogram(buckets):
+    return {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0}
+
+
+histograms = {
+    'phase':    {phase: new_histogram(PHASE_BUCKETS) for phase in TICK_PHASES},   # per wakeup
+    'loop_lag': new_histogram(PHASE_BUCKETS),
+    'queue_depth': new_histogram(DEPTH_BUCKETS),   # per recipient per egress flush
+}
+
+
+def observe(histogram, value):
+    histogram['sum'] += value
+    counts = histogram['counts']
+    for i, bound in enumerate(histogram['buckets']):
+        if value <= bound:
+            counts[i] += 1
+            return
+    counts[-1] += 1
+
+
+def count_received(action, size):
+    metrics['packets_in'][action] += 1
+    metrics['bytes_in'][action]   += size
+
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metric(lines, name, kind, text, samples):
+    """
+    Append one metric family; 'samples' is a list of (labels dict, value).
+    """
+    lines.append('# HELP tetanki_%s %s' % (name, text))
+    lines.append('# TYPE tetanki_%s %s' % (name, kind))
+    for labels, value in samples:
+        label_text = ','.join('%s="%s"' % (k, metric_label(v)) for k, v in labels.items())
+        lines.append('tetanki_%s%s %s' % (name, '{%s}' % label_text if label_text else '', value))
+
+
+def render_histogram(lines, name, text, label, histograms_by_label):
+    lines.append('# HELP tetanki_%s %s' % (name, text))
+    lines.append('# TYPE tetanki_%s histogram' % name)
+    for value, histogram in histograms_by_label.items():
+        prefix = '%s="%s",' % (label, metric_label(value)) if label else ''
+        total  = 0
+        for bound, count in zip(histogram['buckets'] + ('+Inf',), histogram['counts']):
+            total += count
+            lines.append('tetanki_%s_bucket{%sle="%s"} %d' % (name, prefix, bound, total))
+        labels = '{%s}' % prefix[:-1] if prefix else ''
+        lines.append('tetanki_%s_sum%s %.6f' % (name, labels, histogram['sum']))
+        lines.append('tetanki_%s_count%s %d' % (name, labels, total))
+
+
+def render_metrics(front=False):
+    """
+    Every metric of this process in the Prometheus text format. The
+    sharding front end only has its forwarding counters.
+    """
+    lines = []
+    if front:
+        render_metric(lines, 'front_datagrams_total', 'counter', 'Datagrams handled by the front end.',
+                      [({'result': k}, v) for k, v in front_stats.items()]
+                      + [({'result': 'oversize'}, traffic_stats['oversize'])])
+        return '\n'.join(lines) + '\n'
+
+    for direction in ('in', 'out'):
+        render_metric(lines, 'packets_%s_total' % direction, 'counter', 'Datagrams %s, by action.'
+                      % ('received' if direction == 'in' else 'sent'),
+                      [({'action': k}, v) for k, v in sorted(metrics['packets_' + direction].items())])
+        render_metric(lines, 'bytes_%s_total' % direction, 'counter', 'Bytes %s, by action.'
+                      % ('received' if direction == 'in' else 'sent'),
+                      [({'action': k}, v) for k, v in sorted(metrics['bytes_' + direction].items())])
+    render_metric(lines, 'room_bytes_out_total', 'counter', 'Bytes of state updates sent, by room.',
+                  [({'room': k}, v) for k, v in sorted(metrics['room_bytes_out'].items())])
+    render_metric(lines, 'room_seconds_total', 'counter',
+                  'Time spent on a room\'s inputs, simulation and broadcasts.',
+                  [({'room': k}, '%.6f' % v) for k, v in sorted(metrics['room_seconds'].items())])
+    render_histogram(lines, 'tick_phase_seconds', 'Time per game_tick wakeup spent in each phase.',
+                     'phase', histograms['phase'])
+    render_histogram(lines, 'loop_lag_seconds', 'How late the event loop woke up a sleeping task.',
+                     None, {None: histograms['loop_lag']})
+
+    render_metric(lines, 'ticks_total', 'counter', 'Simulation ticks run.', [({}, tick_stats['ticks'])])
+    render_metric(lines, 'tick_overruns_total', 'counter', 'Wakeups whose work exceeded one tick.',
+                  [({}, tick_stats['overruns'])])
+    render_metric(lines, 'ticks_dropped_total', 'counter', 'Ticks skipped after a stall.',
+                  [({}, tick_stats['dropped'])])
+    render_metric(lines, 'inputs_total', 'counter', 'Room inputs, by outcome.',
+                  [({'result': k}, v) for k, v in input_stats.items()])
+    render_metric(lines, 'traffic_rejected_total', 'counter', 'Datagrams dropped or refused, by reason.',
+                  [({'reason': k}, v) for k, v in traffic_stats.items() if k != 'rate_limited']
+                  + [({'reason': 'rate_limited_' + k}, v) for k, v in traffic_stats['rate_limited'].items()])
+    render_metric(lines, 'egress_total', 'counter', 'Egress flushes, datagrams sent, send syscalls and drops.',
+                  [({'kind': k}, v) for k, v in egress_stats.items() if k != 'max_depth'])
+    render_metric(lines, 'egress_max_queue_depth', 'gauge', 'Deepest recipient queue seen at a flush.',
+                  [({}, egress_stats['max_depth'])])
+    render_histogram(lines, 'egress_queue_depth', 'Datagrams queued for one recipient at a flush.',
+                     None, {None: histograms['queue_depth']})
+    render_metric(lines, 'log_records_total', 'counter', 'Log records, by outcome.',
+                  [({'result': k}, v) for k, v in log_stats.items()])
+
+    render_metric(lines, 'rooms', 'gauge', 'Open rooms.', [({}, len(rooms))])
+    render_metric(lines, 'active_rooms', 'gauge', 'Rooms visited by game_tick.', [({}, len(active_rooms))])
+    render_metric(lines, 'sessions', 'gauge', 'Connected client addresses.', [({}, len(sessions))])
+    render_metric(lines, 'room_players', 'gauge', 'Players, by room.',
+                  [({'room': k}, len(room['players'])) for k, room in rooms.items()])
+    render_metric(lines, 'room_bullets', 'gauge', 'Bullets in flight, by room.',
+                  [({'room': k}, len(room['bullets'])) for k, room in rooms.items()])
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics_request(reader, writer, front=False):
+    """
+    Minimal HTTP/1.0: GET /metrics, or GET /profile?seconds=N to start
+    the sampling profiler.
+    """
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        for _ in range(100):   # skip the headers
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+    except (asyncio.TimeoutError, ConnectionError, ValueError):
+        writer.close()
+        return
+    parts = request.decode('latin-1').split()
+    url   = urllib.parse.urlsplit(parts[1] if len(parts) > 1 else '')
+    if url.path == '/metrics':
+        status, body = '200 OK', render_metrics(front)
+    elif url.path == '/profile':
+        try:
+            seconds = float(urllib.parse.parse_qs(url.query).get('seconds', [PROFILE_SECONDS])[0])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            status, body = '400 Bad Request', 'seconds must be between 0 and %d\n' % PROFILE_MAX_SECONDS
+        else:
+            path = start_profiler(seconds)
+            if path is None:
+                status, body = '409 Conflict', 'a profile is already being taken\n'
+            else:
+                status, body = '200 OK', 'profiling for %g s into %s\n' % (seconds, path)
+    else:
+        status, body = '404 Not Found', 'try /metrics or /profile?seconds=N\n'
+    data = body.encode('utf-8')
+    writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(data))).encode('ascii') + data)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def start_metrics_server(port, front=False):
+    try:
+        # SO_REUSEPORT lets the new process of a hot restart listen before the old one exits
+        await asyncio.start_server(lambda r, w: handle_metrics_request(r, w, front), METRICS_HOST, port,
+                                   reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+    except OSError as exc:
+        log_event('metrics_failed', level='error', port=port, error=str(exc))
+        return
+    log_event('metrics_listening', address=[METRICS_HOST, port])
+
+
+async def loop_lag_task():
+    """
+    Measure how much later than asked the event loop wakes up a sleeping
+    task, i.e. how long other work (ticks, packets) held the loop.
+    """
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe(histograms['loop_lag'], max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL))
+
+
+def start_profiler(seconds=PROFILE_SECONDS):
+    """
+    Sample the calling (event loop) thread's stack every PROFILE_INTERVAL
+    seconds for 'seconds' from a background thread, then write the
+    samples in the collapsed-stack format read by flamegraph.pl and
+    speedscope. Returns the file path, or None if a profile is already
+    being taken.
+    """
+    if profiler['thread'] is not None and profiler['thread'].is_alive():
+        return None
+    path = os.path.join(PROFILE_DIR, 'profile-%d-%d.folded' % (os.getpid(), time.time()))
+    profiler['thread'] = threading.Thread(target=sample_stacks, daemon=True,
+                                          args=(threading.get_ident(), seconds, path))
+    profiler['thread'].start()
+    log_event('profile_started', seconds=seconds, path=path)
+    return path
+
+
+def sample_stacks(thread_id, seconds, path):
+    """
+    Profiler thread: count the distinct stacks of thread 'thread_id'.
+    """
+    stacks   = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(PROFILE_INTERVAL)
+    try:
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+    except OSError as exc:
+        log_event('profile_failed', level='error', path=path, error=str(exc))
+        return
+    log_event('profile_written', path=path, samples=sum(stacks.values()))
+
+
+# ------------------------------------------------------------------
+# Egress: datagrams are queued per recipient and flushed in batches,
+# once per game_tick wakeup and after each burst of received packets.
+# On Linux a flush is one sendmmsg(2) call per EGRESS_BATCH datagrams;
+# every recipient of an encoded frame shares the same buffer.
+# ------------------------------------------------------------------
+class IOVec(ctypes.Structure):
+    _fields_ = [('base', ctypes.c_void_p), ('len', ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_void_p), ('namelen', ctypes.c_uint32),
+                ('iov', ctypes.POINTER(IOVec)), ('iovlen', ctypes.c_size_t),
+                ('control', ctypes.c_void_p), ('controllen', ctypes.c_size_t),
+                ('flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('hdr', MsgHdr), ('len', ctypes.c_uint)]
+
+
+try:
+    libc_sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc_sendmmsg.restype  = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    libc_sendmmsg = None   # not Linux: plain sendto
+
+egress = {
+    'queues': {},         # address -> datagrams waiting for the next flush, in order
+    'transport': None,    # what the queued datagrams are sent with
+    'scheduled': False,   # a flush is scheduled on the event loop
+    'sockaddrs': {},      # address -> packed sockaddr for sendmmsg
+}
+egress_stats = {
+    'flushes': 0,
+    'datagrams': 0,       # datagrams handed to the kernel
+    'syscalls': 0,        # sendmmsg or sendto calls
+    'dropped': 0,         # queue overflow, full socket buffer or send error
+    'max_depth': 0,       # deepest recipient queue seen at a flush
+}
+
+
+def send_packet(transport, data, addr, action, room_id=None):
+    """
+    Queue one datagram for 'addr' and count it under 'action' (and
+    'room_id'). It goes out with the next flush_egress.
+    """
+    pending = egress['queues'].get(addr)
+    if pending is None:
+        pending = egress['queues'][addr] = []
+    elif len(pending) >= EGRESS_QUEUE_LIMIT:
+        del pending[0]
+        egress_dropped(addr, 1)
+    pending.append(data)
+    egress['transport'] = transport
+    if not egress['scheduled']:
+        egress['scheduled'] = True
+        try:
+            asyncio.get_running_loop().call_soon(flush_egress)
+        except RuntimeError:
+            egress['scheduled'] = False   # no event loop (scripts, tests): the caller flushes
+    metrics['packets_out'][action] += 1
+    metrics['bytes_out'][action]   += len(data)
+    if room_id is not None:
+        metrics['room_bytes_out'][room_id] += len(data)
+
+
+def egress_dropped(addr, count):
+    egress_stats['dropped'] += count
+    session = sessions.get(addr)
+    if session is not None:
+        session['send_dropped'] += count
+
+
+def flush_egress():
+    """
+    Send everything queued, recipient by recipient.
+    """
+    egress['scheduled'] = False
+    queues = egress['queues']
+    if not queues:
+        return
+    egress['queues'] = {}
+    egress_stats['flushes'] += 1
+    batch = []
+    for addr, datagrams in queues.items():
+        depth = len(datagrams)
+        egress_stats['max_depth'] = max(egress_stats['max_depth'], depth)
+        observe(histograms['queue_depth'], depth)
+        session = sessions.get(addr)
+        if session is not None and depth > session.get('queue_max', 0):
+            session['queue_max'] = depth
+        batch.extend((data, addr) for data in datagrams)
+
+    transport = egress['transport']
+    sock = transport.get_extra_info('socket')
+    if USE_SENDMMSG and libc_sendmmsg is not None and sock is not None:
+        for start in range(0, len(batch), EGRESS_BATCH):
+            send_batch(sock.fileno(), batch[start:start + EGRESS_BATCH])
+    else:
+        for data, addr in batch:
+            egress_stats['syscalls'] += 1
+            try:
+                transport.sendto(data, addr)
+                egress_stats['datagrams'] += 1
+            except OSError:
+                egress_dropped(addr, 1)
+
+
+def packed_sockaddr(addr):
+    """
+    sockaddr_in or sockaddr_in6 for an address tuple, kept for reuse.
+    """
+    packed = egress['sockaddrs'].get(addr)
+    if packed is None:
+        host, port = addr[0], addr[1]
+        if ':' in host:
+            flowinfo, scope_id = (addr[2], addr[3]) if len(addr) == 4 else (0, 0)
+            raw = (struct.pack('=H', socket.AF_INET6) + struct.pack('!HI', port, flowinfo)
+                   + socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', scope_id))
+        else:
+            raw = (struct.pack('=H', socket.AF_INET) + struct.pack('!H', port)
+                   + socket.inet_aton(host) + bytes(8))
+        if len(egress['sockaddrs']) >= MAX_TRACKED_ADDRESSES:
+            egress['sockaddrs'].clear()
+        packed = egress['sockaddrs'][addr] = ctypes.create_string_buffer(raw, len(raw))
+    return packed
+
+
+def send_batch(fd, batch):
+    """
+    Send (data, addr) pairs with as few sendmmsg calls as the kernel
+    allows. If the socket buffer is full the rest are dropped; a
+    datagram the kernel refuses is dropped and the batch goes on.
+    """
+    count    = len(batch)
+    messages = (MMsgHdr * count)()
+    iovecs   = (IOVec * count)()
+    buffers  = {}   # id(data) -> address of its bytes, one per distinct frame
+    for i, (data, addr) in enumerate(batch):
+        base = buffers.get(id(data))
+        if base is None:
+            base = buffers[id(data)] = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        iovecs[i].base = base
+        iovecs[i].len  = len(data)
+        sockaddr = packed_sockaddr(addr)
+        hdr = messages[i].hdr
+        hdr.name    = ctypes.addressof(sockaddr)
+        hdr.namelen = len(sockaddr)
+        hdr.iov     = ctypes.pointer(iovecs[i])
+        hdr.iovlen  = 1
+
+    sent    = 0
+    retried = False
+    while sent < count:
+        egress_stats['syscalls'] += 1
+        n = libc_sendmmsg(fd, ctypes.addressof(messages) + sent * ctypes.sizeof(MMsgHdr),
+                          count - sent, socket.MSG_DONTWAIT)
+        if n > 0:
+            egress_stats['datagrams'] += n
+            sent += n
+            retried = False
+            continue
+        err = ctypes.get_errno()
+        # ECONNREFUSED reports an ICMP error for an earlier datagram; retry this one once
+        if err == errno.EINTR or (err == errno.ECONNREFUSED and not retried):
+            retried = True
+            continue
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            for _, addr in batch[sent:]:
+                egress_dropped(addr, 1)   # socket buffer full: UDP, so drop rather than wait
+            return
+        egress_dropped(batch[sent][1], 1)  # e.g. an unreachable address: skip that one
+        sent += 1
+
+
+# -----------------------------------------------------------
+# Spatial grid: which players are near a point (broad-phase)
+# -----------------------------------------------------------
+def grid_cell(x, y):
+    return int(x // GRID_CELL_SIZE), int(y // GRID_CELL_SIZE)
+
+
+def set_player_position(room, pid, x, y):
+    """
+    Move a player and keep the room's spatial grid in sync.
+    """
+    p = room['players'][pid]
+    p['position'] = {'x': x, 'y': y}
+    cell = grid_cell(x, y)
+    old  = p.get('cell')
+    if old == cell:
+        return
+    if old is not None:
+        room['grid'][old].discard(pid)
+        if not room['grid'][old]:
+            del room['grid'][old]
+    room['grid'].setdefault(cell, set()).add(pid)
+    p['cell'] = cell
+
+
+# ---------------------------------------------------------
+# Player registry: O(1) lookups from player id and address
+# ---------------------------------------------------------
+player_rooms = {}   # player_id -> id of the room the player is in
+sessions     = {}   # client address -> session of the player at that address (see new_session)
+
+# Heartbeat timer wheel: each session sits in one slot, and one slot is
+# visited every PING_INTERVAL / HEARTBEAT_SLOTS seconds
+heartbeat_wheel = [set() for _ in range(HEARTBEAT_SLOTS)]   # slot -> addresses
+heartbeat_slots = itertools.count()                          # sessions created so far
+
+
+def new_session(pid):
+    """
+    Liveness and latency state for the player at one address.
+    """
+    # golden-ratio steps spread any number of sessions evenly around the wheel
+    slot = int((next(heartbeat_slots) * 0.6180339887) % 1.0 * HEARTBEAT_SLOTS)
+    return {
+        'player_id': pid,
+        'slot': slot,                     # heartbeat wheel slot
+        'last_seen': clock.monotonic(),   # any packet from the address counts
+        'ping_sent': None,                # when the unanswered ping went out
+        'rtt': None,                      # smoothed round-trip time (seconds)
+        'rtt_last': None,                 # latest round-trip sample
+        'send_dropped': 0,                # datagrams to this address dropped by the egress
+        'queue_max': 0,                   # deepest egress queue for this address at a flush
+    }
+
+
+def add_player(room, pid, p, x, y):
+    """
+    Put player data 'p' into a room at (x, y) and register the player.
+    """
+    room['players'][pid] = p
+    set_player_position(room, pid, x, y)
+    player_rooms[pid] = room['name']
+    session = sessions[p['address']] = new_session(pid)
+    heartbeat_wheel[session['slot']].add(p['address'])
+
+
+def remove_player(room, pid):
+    """
+    Delete a player from a room, its waiting room, its spatial grid and
+    the registry.
+    """
+    p = room['players'].pop(pid)
+    room['moving'].discard(pid)
+    if pid in room['waiting_room']:
+        room['waiting_room'].remove(pid)
+    cell = p.get('cell')
+    if cell is not None:
+        room['grid'][cell].discard(pid)
+        if not room['grid'][cell]:
+            del room['grid'][cell]
+    if player_rooms.get(pid) == room['name']:
+        del player_rooms[pid]
+    session = sessions.get(p['address'])
+    if session is not None and session['player_id'] == pid:
+        del sessions[p['address']]
+        heartbeat_wheel[session['slot']].discard(p['address'])
+
+
+def players_near_segment(grid, x0, y0, x1, y1):
+    """
+    Ids of the players in 'grid' (a room's, or a history frame's) whose
+    cell is within PLAYER_RADIUS of the bounding box of the segment
+    (x0, y0)-(x1, y1).
+    """
+    cx0, cy0 = grid_cell(min(x0, x1) - PLAYER_RADIUS, min(y0, y1) - PLAYER_RADIUS)
+    cx1, cy1 = grid_cell(max(x0, x1) + PLAYER_RADIUS, max(y0, y1) + PLAYER_RADIUS)
+    found = []
+    for cx in range(cx0, cx1 + 1):
+        for cy in range(cy0, cy1 + 1):
+            cell = grid.get((cx, cy))
+            if cell:
+                found.extend(cell)
+    return found
+
+
+def segment_hit_time(x0, y0, x1, y1, cx, cy, radius):
+    """
+    Earliest fraction t in [0, 1] at which the point moving from (x0, y0)
+    to (x1, y1) is within 'radius' of (cx, cy), or None if it never is.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    fx, fy = x0 - cx, y0 - cy
+    c = fx * fx + fy * fy - radius * radius
+    if c <= 0:
+        return 0.0                      # already touching at the start
+    a = dx * dx + dy * dy
+    if a == 0:
+        return None
+    b = 2 * (fx * dx + fy * dy)
+    disc = b * b - 4 * a * c
+    if disc < 0:
+        return None
+    t = (-b - math.sqrt(disc)) / (2 * a)
+    return t if 0 <= t <= 1 else None
+
+
+# ----------------------------------------------------------
+# Bullets: straight-line motion derived from the spawn record
+# ----------------------------------------------------------
+def bullet_position(bullet, now):
+    """
+    Position of a bullet at time 'now'. Bullets never change course, so
+    the server and the clients can both compute this from the spawn
+    record (origin, direction, created) without per-tick updates.
+    """
+    dx, dy   = DIRECTIONS.get(bullet['direction'], (1, 0))
+    distance = BULLET_SPEED * (now - bullet['created'])
+    return (bullet['origin']['x'] + dx * distance,
+            bullet['origin']['y'] + dy * distance)
+
+
+def add_bullet(room, bullet):
+    """
+    Append a spawn record to the room (and to its NumPy mirror, if any).
+    """
+    room['bullets'].append(bullet)
+    if room['bullet_arrays'] is not None:
+        room['bullet_arrays'].append(bullet)
+
+
+class BulletArrays:
+    """
+    Struct-of-arrays mirror of a room's bullet list for the NumPy engine:
+    row i always describes room['bullets'][i]. Arrays grow by doubling,
+    so appending a bullet is amortized O(1).
+    """
+
+    def __init__(self, bullets):
+        n = len(bullets)
+        self.size    = n
+        self.ox      = np.fromiter((b['origin']['x'] for b in bullets), float, n)
+        self.oy      = np.fromiter((b['origin']['y'] for b in bullets), float, n)
+        self.dx      = np.fromiter((DIRECTIONS.get(b['direction'], (1, 0))[0] for b in bullets), float, n)
+        self.dy      = np.fromiter((DIRECTIONS.get(b['direction'], (1, 0))[1] for b in bullets), float, n)
+        self.created = np.fromiter((b['created'] for b in bullets), float, n)
+        self.owner   = np.fromiter((assign_player_num(b['player_id']) for b in bullets), np.int64, n)
+        self.rewind  = np.fromiter((b.get('rewind', 0.0) for b in bullets), float, n)
+
+    FIELDS = ('ox', 'oy', 'dx', 'dy', 'created', 'owner', 'rewind')
+
+    def append(self, b):
+        if self.size == len(self.ox):
+            capacity = max(64, 2 * self.size)
+            for name in self.FIELDS:
+                old = getattr(self, name)
+                new = np.empty(capacity, old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+        i = self.size
+        self.ox[i], self.oy[i] = b['origin']['x'], b['origin']['y']
+        self.dx[i], self.dy[i] = DIRECTIONS.get(b['direction'], (1, 0))
+        self.created[i] = b['created']
+        self.owner[i]   = assign_player_num(b['player_id'])
+        self.rewind[i]  = b.get('rewind', 0.0)
+        self.size += 1
+
+    def keep(self, mask):
+        """Drop every row where 'mask' (length == size) is False."""
+        for name in self.FIELDS:
+            setattr(self, name, getattr(self, name)[:self.size][mask])
+        self.size = int(mask.sum())
+
+    def positions(self, t):
+        """Vectorized bullet_position() for per-row times 't'."""
+        n = self.size
+        distance = BULLET_SPEED * (t - self.created[:n])
+        return self.ox[:n] + self.dx[:n] * distance, self.oy[:n] + self.dy[:n] * distance
+
+
+# ------------------------------------------------------------
+# Rewind buffer: tank positions of the last REWIND_HISTORY_TICKS ticks
+# ------------------------------------------------------------
+def record_positions(room, now):
+    """
+    Remember where every live tank is at tick time 'now'. The frame's
+    spatial grid is only built if a lag-compensated bullet needs it.
+    """
+    room['history'].append([now, {
+        pid: (info['position']['x'], info['position']['y'])
+        for pid, info in room['players'].items()
+        if info['position'] and info['hp'] > 0
+    }, None])
+
+
+def history_frame(room, when):
+    """
+    The frame recorded at the last tick at or before 'when' (the oldest
+    one if 'when' is older than the buffer), or None before the first tick.
+    """
+    history = room['history']
+    for frame in reversed(history):
+        if frame[0] <= when:
+            return frame
+    return history[0] if history else None
+
+
+def frame_grid(frame):
+    """
+    Spatial grid (cell -> player ids) of a history frame, built on first use.
+    """
+    if frame[2] is None:
+        grid = {}
+        for pid, (x, y) in frame[1].items():
+            grid.setdefault(grid_cell(x, y), []).append(pid)
+        frame[2] = grid
+    return frame[2]
+
+
+def rewound_hit(room, bullet, x0, y0, x1, y1, when):
+    """
+    The first tank a lag-compensated bullet touches on its way from
+    (x0, y0) to (x1, y1), with the tanks where they were at 'when'.
+    Only tanks in nearby cells of that frame's grid are tested.
+    """
+    frame = history_frame(room, when)
+    if frame is None:
+        return None
+    positions = frame[1]
+    hit_t, hit_pid = None, None
+    for pid in players_near_segment(frame_grid(frame), x0, y0, x1, y1):
+        info = room['players'].get(pid)
+        # skip the shooter and players that are gone or dead by now
+        if pid == bullet['player_id'] or info is None or info['hp'] <= 0:
+            continue
+        cx, cy = positions[pid]
+        t = segment_hit_time(x0, y0, x1, y1, cx, cy, PLAYER_RADIUS)
+        if t is not None and (hit_t is None or (t, pid) < (hit_t, hit_pid)):
+            hit_t, hit_pid = t, pid
+    return hit_pid
+
+
+# ------------------------------------------------------
+# Snapshots: public copy of a room that clients receive
+# ------------------------------------------------------
+def take_snapshot(room):
+    """
+    Copy the public part of a room. Snapshots are never mutated after
+    creation, so they can be kept as delta baselines for each client.
+    Bullet spawn records are immutable too and are shared, not copied.
+    """
+    players = {}
+    for pid, info in room['players'].items():
+        pub = {f: info[f] for f in PUBLIC_PLAYER_FIELDS}
+        pub['position'] = dict(info['position'])
+        players[pid] = pub
+    bullets = {b['id']: b for b in room['bullets']}
+    return {
+        'name': room['name'],
+        'waiting_room': list(room['waiting_room']),
+        'players': players,
+        'bullets': bullets,
+        'game_started': room['game_started'],
+    }
+
+
+def public_bullet(b):
+    return {f: b[f] for f in PUBLIC_BULLET_FIELDS}
+
+
+def interest_cell(x, y):
+    return int(x // INTEREST_CELL_SIZE), int(y // INTEREST_CELL_SIZE)
+
+
+def cells_near(a, b):
+    return abs(a[0] - b[0]) <= 1 and abs(a[1] - b[1]) <= 1
+
+
+def snapshot_cells(snapshot, now):
+    """
+    Interest cell of every tank and bullet in a snapshot.
+    """
+    players = {pid: interest_cell(p['position']['x'], p['position']['y'])
+               for pid, p in snapshot['players'].items()}
+    bullets = {bid: interest_cell(*bullet_position(b, now)) for bid, b in snapshot['bullets'].items()}
+    return players, bullets
+
+
+def view_snapshot(snapshot, cell, cells, base):
+    """
+    The snapshot as seen from interest cell 'cell' between far updates:
+    tanks and bullets near the cell are current, the rest are as the
+    client already has them in 'base' (its delta baseline, or the last
+    view it was sent). Far ones it never had are left out until the
+    next far update.
+    """
+    player_cells, bullet_cells = cells
+    base_players = base['players'] if base else {}
+    base_bullets = base['bullets'] if base else {}
+    players = {}
+    for pid, p in snapshot['players'].items():
+        if cells_near(player_cells[pid], cell):
+            players[pid] = p
+        elif pid in base_players:
+            players[pid] = base_players[pid]
+    bullets = {bid: b for bid, b in snapshot['bullets'].items()
+               if bid in base_bullets or cells_near(bullet_cells[bid], cell)}
+    return {**snapshot, 'players': players, 'bullets': bullets}
+
+
+def snapshot_state(snapshot, now):
+    """
+    Convert a snapshot into the 'game_state' layout of a full update.
+    Bullets get their current 'position' for clients that don't extrapolate.
+    """
+    bullets = []
+    for b in snapshot['bullets'].values():
+        x, y = bullet_position(b, now)
+        bullets.append({**public_bullet(b), 'position': {'x': x, 'y': y}})
+    return {
+        'name': snapshot['name'],
+        'waiting_room': snapshot['waiting_room'],
+        'players': snapshot['players'],
+        'bullets': bullets,
+        'game_started': snapshot['game_started'],
+    }
+
+
+def diff_snapshots(base, cur):
+    """
+    Return only what changed between two snapshots of the same room.
+    Empty sections are left out of the result.
+    """
+    delta = {}
+
+    players = {}
+    for pid, p in cur['players'].items():
+        old = base['players'].get(pid)
+        if old is None:
+            players[pid] = p                      # new player: send everything
+        else:
+            changed = {k: v for k, v in p.items() if old[k] != v}
+            if changed:
+                players[pid] = changed
+    if players:
+        delta['players'] = players
+    removed = [pid for pid in base['players'] if pid not in cur['players']]
+    if removed:
+        delta['players_removed'] = removed
+
+    # bullets only ever appear or disappear; clients extrapolate the motion
+    added = [public_bullet(b) for bid, b in cur['bullets'].items() if bid not in base['bullets']]
+    if added:
+        delta['bullets_added'] = added
+    removed = [bid for bid in base['bullets'] if bid not in cur['bullets']]
+    if removed:
+        delta['bullets_removed'] = removed
+
+    if base['waiting_room'] != cur['waiting_room']:
+        delta['waiting_room'] = cur['waiting_room']
+    if base['game_started'] != cur['game_started']:
+        delta['game_started'] = cur['game_started']
+    return delta
+
+
+def handle_ack(p, seq):
+    """
+    A delta client confirmed snapshot 'seq': make it the new baseline
+    and forget every older pending snapshot.
+    """
+    pending = p['pending']
+    if seq not in pending:
+        return  # too old or never sent
+    p['baseline'] = (seq, pending[seq])
+    for old_seq in [s for s in pending if s <= seq]:
+        del pending[old_seq]
+
+
+# ------------------------------------------------------------
+# Wire formats: JSON for everyone, binary for clients that ask
+# ------------------------------------------------------------
+WIRE_JSON   = 'json'
+WIRE_BINARY = 'binary'
+
+player_nums    = {}   # player_id -> small number used by the binary protocol
+players_by_num = {}   # number -> player_id
+next_player_num = 1
+
+
+def assign_player_num(player_id):
+    """
+    Give 'player_id' a number that fits in 16 bits. Numbers stay with the
+    id for the server's lifetime, so a client that has already left can
+    still be named in 'players_removed'; when they run out, numbers of ids
+    that are no longer in any room are reused. With several workers,
+    worker i only hands out numbers n with (n - 1) % shard_count == i, so
+    the front process can route binary packets by number.
+    """
+    global next_player_num
+    num = player_nums.get(player_id)
+    if num is not None:
+        return num
+    if next_player_num > 0xFFFF:
+        for old_id in [pid for pid in player_nums if pid not in player_rooms]:
+            del players_by_num[player_nums.pop(old_id)]
+        next_player_num = shard_index + 1
+    while next_player_num in players_by_num:
+        next_player_num += shard_count
+    num = next_player_num
+    next_player_num += shard_count
+    player_nums[player_id] = num
+    players_by_num[num]    = player_id
+    return num
+
+
+def encode_message(message, fmt):
+    """
+    Encode a server message dict in the given wire format.
+    """
+    if fmt == WIRE_BINARY:
+        if message['action'] == 'ping':
+            return wire.encode_ping()
+        return wire.encode_state(message, player_nums)
+    return json.dumps(message).encode('utf-8')
+
+
+def decode_message(data):
+    """
+    Decode a client packet, binary or JSON, into a message dict.
+    Returns None for anything malformed.
+    """
+    if wire.is_binary(data):
+        try:
+            msg = wire.decode_client(data)
+        except wire.WireError:
+            return None
+        msg['player_id'] = players_by_num.get(msg.pop('player_num'))
+        return msg
+    try:
+        msg = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    return msg if isinstance(msg, dict) else None
+
+
+# -----------------------------------------------------
+# Broadcast the game state to all connected players
+# -----------------------------------------------------
+def broadcast_state(transport, room_id):
+    """
+    Send the current room state to every player.
+
+    Plain clients get an 'update_state' with the full public state.
+    Clients that joined with 'delta' get an 'update_delta' against the
+    last snapshot they acknowledged, or a full keyframe when they have no
+    baseline yet or KEYFRAME_INTERVAL snapshots have passed since the last one.
+    With INTEREST_CELL_SIZE set, far-away parts of the room are only
+    updated every FAR_UPDATE_EVERY snapshots (see view_snapshot).
+    Each distinct view is built once and encoded once per wire format.
+    """
+    started = time.perf_counter()
+    room = rooms[room_id]
+    room['dirty']     = False
+    room['last_sent'] = current_tick
+    room['snapshot_seq'] += 1
+    seq      = room['snapshot_seq']
+    snapshot = take_snapshot(room)
+    now      = clock.time()
+    events   = room['events']   # hits since the last broadcast, sent once
+    room['events'] = []
+
+    # between far updates each interest cell has its own view
+    cells = snapshot_cells(snapshot, now) if INTEREST_CELL_SIZE and seq % FAR_UPDATE_EVERY else None
+
+    views    = {}   # (base seq (None = full update), interest cell, far base) -> snapshot sent
+    messages = {}   # same key -> message dict
+    encoded  = {}   # (wire format,) + view key -> bytes, shared by clients with the same view
+    for pid, info in list(room['players'].items()):
+        baseline = info.get('baseline')
+        if info.get('delta') and baseline and seq - info['last_keyframe'] < KEYFRAME_INTERVAL:
+            base_seq, base = baseline
+        else:
+            base_seq, base = None, None
+            info['last_keyframe'] = seq
+
+        # a full update replaces the client's whole state, so far tanks and
+        # bullets are repeated as it was last sent them
+        far_base = base if base is not None else info.get('last_view')
+        view_key = (base_seq, cells and cells[0][pid], id(far_base) if cells and base is None else None)
+        view = views.get(view_key)
+        if view is None:
+            view = views[view_key] = view_snapshot(snapshot, view_key[1], cells, far_base) if cells else snapshot
+        key  = (info['wire'],) + view_key
+        data = encoded.get(key)
+        if data is None:
+            message = messages.get(view_key)
+            if message is None:
+                if base is None:
+                    message = {
+                        'action': 'update_state',
+                        'seq': seq,
+                        'game_state': snapshot_state(view, now),
+                        'timestamp': now,
+                    }
+                else:
+                    message = {
+                        'action': 'update_delta',
+                        'seq': seq,
+                        'base': base_seq,
+                        'timestamp': now,
+                    }
+                    message.update(diff_snapshots(base, view))
+                if events:
+                    message['events'] = events
+                messages[view_key] = message
+            data = encode_message(message, info['wire'])
+            encoded[key] = data
+        send_packet(transport, data, info['address'],
+                    'update_state' if base_seq is None else 'update_delta', room_id)
+        info['last_view'] = view
+
+        if info.get('delta'):
+            # remember what was sent until the client acknowledges it
+            pending = info['pending']
+            pending[seq] = view
+            while len(pending) > MAX_PENDING_SNAPSHOTS:
+                del pending[next(iter(pending))]
+
+    elapsed = time.perf_counter() - started
+    tick_phases['serialization'] += elapsed
+    metrics['room_seconds'][room_id] += elapsed
+
+
+# ----------------------------------------------------------------
+# Action handlers. Server handlers run for any sender; player handlers
+# only for players that are in a room, and get that room and player.
+# Handlers return True when they changed the room state.
+# ----------------------------------------------------------------
+SERVER_HANDLERS = {}   # action -> handler(transport, addr, msg, player_id)
+PLAYER_HANDLERS = {}   # action -> handler(transport, addr, msg, player_id, room, p)
+
+
+def server_action(name):
+    def register(handler):
+        SERVER_HANDLERS[name] = handler
+        return handler
+    return register
+
+
+def player_action(name):
+    def register(handler):
+        PLAYER_HANDLERS[name] = handler
+        return handler
+    return register
+
+
+# -------------------------------------------
+# Handle new player joining the waiting room
+# -------------------------------------------
+@server_action('join_room')
+def handle_join_room(transport, addr, msg, player_id):
+    # 1) Validate room_name, and that nobody else is playing as player_id
+    room_name = msg.get('room_name')
+    old_name  = player_rooms.get(player_id)
+    old       = rooms[old_name]['players'][player_id] if old_name is not None else None
+    if not isinstance(room_name, str) or room_name not in rooms:
+        error = 'invalid or missing room_name'
+    elif old is not None and old['address'] != addr \
+            and clock.monotonic() - sessions[old['address']]['last_seen'] < PONG_TIMEOUT:
+        error = 'player_id is in use'
+    elif len(rooms[room_name]['players']) >= MAX_PLAYERS_PER_ROOM and old_name != room_name:
+        error = 'room is full'
+    else:
+        error = None
+    if error:
+        traffic_stats['rejected_joins'] += 1
+        send_packet(transport, json.dumps({
+            'action': 'join_room_response',
+            'success': False,
+            'error': error
+        }).encode('utf-8'), addr, 'join_room_response')
+        return False
+
+    # 2) Remove from the previous room (a rejoin starts over); an address
+    #    holds one player, so a new player_id replaces the old one
+    other = sessions[addr]['player_id'] if addr in sessions else None
+    if other is not None and other != player_id:
+        other_room = player_rooms[other]
+        remove_player(rooms[other_room], other)
+        broadcast_state(transport, other_room)
+    if old_name is not None:
+        remove_player(rooms[old_name], player_id)
+        if old_name != room_name:
+            broadcast_state(transport, old_name)
+
+    # 3) Add into the new room
+    new_room = rooms[room_name]
+    p = {
+        'ready': False,
+        'position': None,
+        'direction': "up",
+        'hp': 100,
+        'address': addr,
+        'skin': rng.randint(1, 4),
+    }
+    add_player(new_room, player_id, p, rng.randint(100, 700), rng.randint(100, 500))
+    if not new_room['game_started']:
+        new_room['waiting_room'].append(player_id)
+    else:
+        p['ready'] = True
+    log_event('join', room=room_name, player=player_id)
+    notify_front('joined', room=room_name, player_id=player_id, address=list(addr[:2]))
+
+    # delta-compressed updates and the binary format are opt-in;
+    # a (re)join always starts from a keyframe
+    p['wire']          = WIRE_BINARY if msg.get('wire') == WIRE_BINARY else WIRE_JSON
+    p['delta']         = bool(msg.get('delta'))
+    p['baseline']      = None     # (seq, snapshot) last acknowledged by the client
+    p['pending']       = {}       # seq -> snapshot sent but not yet acknowledged
+    p['last_keyframe'] = 0
+    p['input_seq']     = 0        # highest input_bundle sequence number queued
+    # with server-side movement the client sends move_input instead of positions
+    p['movement']      = 'server' if msg.get('movement') == 'server' else 'client'
+    p['moving']        = None     # direction the tank is driving in (server-side movement)
+    p['move_seq']      = 0        # highest move_input sequence number applied
+
+    # 4) Confirm join and broadcast new state
+    send_packet(transport, json.dumps({
+        'action': 'join_room_response',
+        'success': True,
+        'room_name': room_name,
+        'room_num': new_room['num'],
+        'player_num': assign_player_num(player_id),
+        'wire': p['wire'],
+        'delta': p['delta'],
+        'movement': p['movement'],
+        'tank_speed': TANK_SPEED,
+        # lets clients extrapolate bullets from their spawn record
+        'bullet_speed': BULLET_SPEED,
+        'bullet_lifetime': BULLET_LIFETIME,
+    }).encode('utf-8'), addr, 'join_room_response')
+    return True
+
+
+# ---------------------------------
+# Room management: create/list/close
+# ---------------------------------
+def room_info(room):
+    return {
+        'room_name': room['name'],
+        'room_num': room['num'],
+        'players': len(room['players']),
+        'game_started': room['game_started'],
+        'send_rate': room['send_rate'],
+        'created': room['owner'] is not None,
+    }
+
+
+def close_room(transport, room_id, reason):
+    """
+    Tell every player in the room it is closing, remove them and delete the room.
+    """
+    room = rooms.pop(room_id)
+    active_rooms.pop(room_id, None)
+    data = json.dumps({'action': 'room_closed', 'room_name': room_id, 'reason': reason}).encode('utf-8')
+    for pid in list(room['players']):
+        send_packet(transport, data, room['players'][pid]['address'], 'room_closed')
+        remove_player(room, pid)
+    metrics['room_bytes_out'].pop(room_id, None)
+    metrics['room_seconds'].pop(room_id, None)
+    log_event('room_closed', room=room_id, reason=reason)
+    notify_front('room_closed', room=room_id)
+
+
+@server_action('create_room')
+def handle_create_room(transport, addr, msg, player_id):
+    room_name = msg.get('room_name')
+    send_rate = msg.get('send_rate', SEND_RATE)
+    if not isinstance(room_name, str) or not 0 < len(room_name) <= MAX_ROOM_NAME_LENGTH:
+        error = 'invalid or missing room_name'
+    elif room_name in rooms:
+        error = 'room already exists'
+    elif len(rooms) >= MAX_ROOMS:
+        error = 'too many rooms'
+    elif not isinstance(send_rate, (int, float)) or isinstance(send_rate, bool) \
+            or not 1 <= send_rate <= TICK_RATE:
+        error = 'send_rate must be between 1 and %d' % TICK_RATE
+    else:
+        error = None
+        rooms[room_name] = create_room(room_name, owner=player_id, send_rate=send_rate)
+        log_event('room_created', room=room_name, player=player_id, send_rate=send_rate)
+    if isinstance(room_name, str):
+        notify_front('create_failed' if error else 'room_created', room=room_name)
+    response = {'action': 'create_room_response', 'success': error is None, 'room_name': room_name}
+    if error:
+        response['error'] = error
+    send_packet(transport, json.dumps(response).encode('utf-8'), addr, response['action'])
+    return False
+
+
+@server_action('list_rooms')
+def handle_list_rooms(transport, addr, msg, player_id):
+    # with several workers every worker answers for its own rooms
+    send_packet(transport, json.dumps({
+        'action': 'list_rooms_response',
+        'rooms': [room_info(room) for room in rooms.values()],
+        'shard': shard_index,
+        'shards': shard_count,
+    }).encode('utf-8'), addr, 'list_rooms_response')
+    return False
+
+
+@server_action('close_room')
+def handle_close_room(transport, addr, msg, player_id):
+    room_name = msg.get('room_name')
+    room = rooms.get(room_name) if isinstance(room_name, str) else None
+    if room is None:
+        error = 'no such room'
+    elif room['owner'] != player_id:
+        error = 'only the player who created a room can close it'
+    else:
+        error = None
+        close_room(transport, room_name, 'closed by owner')
+    response = {'action': 'close_room_response', 'success': error is None, 'room_name': room_name}
+    if error:
+        response['error'] = error
+    send_packet(transport, json.dumps(response).encode('utf-8'), addr, response['action'])
+    return False
+
+
+async def room_cleanup_task(transport):
+    """
+    Every ROOM_CLEANUP_INTERVAL seconds close created rooms that have had
+    no players for EMPTY_ROOM_TIMEOUT seconds. Default rooms stay open.
+    Idle rate limit state is dropped at the same time.
+    """
+    while True:
+        now = time.time()
+        prune_rate_buckets(time.monotonic())
+        for room_id, room in list(rooms.items()):
+            if room['players']:
+                room['empty_since'] = None
+            elif room['empty_since'] is None:
+                room['empty_since'] = now
+            elif room['owner'] is not None and now - room['empty_since'] >= EMPTY_ROOM_TIMEOUT:
+                if recorder['file'] is not None:
+                    record_event(RECORD_CLOSE, RECORD_TIMES.pack(now, time.monotonic()) + room_id.encode('utf-8'))
+                close_room(transport, room_id, 'empty')
+        await asyncio.sleep(ROOM_CLEANUP_INTERVAL)
+
+
+# -------------------
+# Handle 'pong' reply
+# -------------------
+@player_action('pong')
+def handle_pong(transport, addr, msg, player_id, room, p):
+    # liveness is already noted on arrival; the pong measures the round trip
+    session = sessions.get(addr)
+    if session is not None and session['ping_sent'] is not None:
+        sample = clock.monotonic() - session['ping_sent']
+        session['ping_sent'] = None
+        session['rtt_last'] = sample
+        session['rtt'] = sample if session['rtt'] is None else \
+            session['rtt'] + RTT_SMOOTHING * (sample - session['rtt'])
+    return False  # no broadcast for pong
+
+
+# -------------------------------------------
+# Handle snapshot acknowledgement (delta mode)
+# -------------------------------------------
+@player_action('ack')
+def handle_ack_message(transport, addr, msg, player_id, room, p):
+    if isinstance(msg.get('seq'), int):
+        handle_ack(p, msg['seq'])
+    return False  # no broadcast for ack
+
+
+# -----------------------
+# Player indicates ready
+# -----------------------
+@player_action('set_ready')
+def handle_set_ready(transport, addr, msg, player_id, room, p):
+    p['ready'] = True
+    log_event('set_ready', room=room['name'], player=player_id)
+    return True
+
+
+# -----------------
+# Player movement
+# -----------------
+def finite_number(v):
+    # a JSON integer can be too large for a float, and bools are ints
+    if not isinstance(v, (int, float)) or isinstance(v, bool):
+        return False
+    try:
+        return math.isfinite(float(v))
+    except OverflowError:
+        return False
+
+
+def valid_position(pos):
+    return isinstance(pos, dict) and all(finite_number(pos.get(k)) for k in ('x', 'y'))
+
+
+@player_action('move')
+def handle_move(transport, addr, msg, player_id, room, p):
+    pos  = msg.get('position')    # expected dict with 'x' and 'y'
+    dir_ = msg.get('direction')   # expected one of DIRECTIONS
+    # only move if player is alive and sent valid data; with server-side
+    # movement the position is the server's, not the client's
+    if p['movement'] == 'client' and valid_position(pos) and isinstance(dir_, str) \
+            and dir_ in DIRECTIONS and p['hp'] > 0:
+        # clamp within map bounds
+        x = max(0, min(MAP_WIDTH, pos['x']))
+        y = max(0, min(MAP_HEIGHT, pos['y']))
+        set_player_position(room, player_id, x, y)
+        p['direction'] = dir_
+        log_event('move', 'debug', room=room['name'], player=player_id, x=x, y=y, direction=dir_)
+    return True
+
+
+@player_action('move_input')
+def handle_move_input(transport, addr, msg, player_id, room, p):
+    """
+    Server-side movement: start driving in 'direction', or stop when it is
+    missing. Inputs at or below the last applied 'move_seq' are ignored.
+    """
+    seq  = msg.get('move_seq')
+    dir_ = msg.get('direction')
+    if p['movement'] != 'server' or not isinstance(seq, int) or seq <= p['move_seq'] \
+            or (dir_ is not None and (not isinstance(dir_, str) or dir_ not in DIRECTIONS)):
+        return False
+    p['move_seq'] = seq
+    p['moving']   = dir_
+    if dir_ is None:
+        room['moving'].discard(player_id)
+    else:
+        p['direction'] = dir_
+        room['moving'].add(player_id)
+    room['move_acks'][player_id] = seq
+    return True
+
+
+def move_tanks(room, dt):
+    """
+    Drive every tank with server-side movement 'dt' seconds further in
+    its direction, within the map. Destroyed tanks stop.
+    """
+    players = room['players']
+    for pid in list(room['moving']):
+        p = players[pid]
+        if p['hp'] <= 0:
+            p['moving'] = None
+            room['moving'].discard(pid)
+            continue
+        dx, dy = DIRECTIONS[p['moving']]
+        pos = p['position']
+        x = max(0, min(MAP_WIDTH, pos['x'] + dx * TANK_SPEED * dt))
+        y = max(0, min(MAP_HEIGHT, pos['y'] + dy * TANK_SPEED * dt))
+        if (x, y) != (pos['x'], pos['y']):
+            set_player_position(room, pid, x, y)
+            room['dirty'] = True
+
+
+# -----------------
+# Player shooting
+# -----------------
+@player_action('shoot')
+def handle_shoot(transport, addr, msg, player_id, room, p):
+    # only shoot if alive, has a valid position and not too many bullets in flight
+    if p['position'] and p['hp'] > 0:
+        if sum(b['player_id'] == player_id for b in room['bullets']) >= MAX_BULLETS_PER_PLAYER:
+            traffic_stats['bullet_cap'] += 1
+            return False
+        origin, direction = p['position'].copy(), p['direction']
+        # the shooter's own view of its tank wins if it is close to the server's copy
+        pos = msg.get('position')
+        if valid_position(pos) and math.hypot(pos['x'] - origin['x'], pos['y'] - origin['y']) <= SHOT_POSITION_TOLERANCE:
+            origin = {'x': max(0, min(MAP_WIDTH, pos['x'])), 'y': max(0, min(MAP_HEIGHT, pos['y']))}
+        if isinstance(msg.get('direction'), str) and msg['direction'] in DIRECTIONS:
+            direction = msg['direction']
+
+        # the shooter sees every tank as it was at 'state_time' (the timestamp
+        # of the state it was showing), so the bullet is tested against tanks
+        # that far in the past for its whole flight, up to MAX_REWIND
+        now    = clock.time()
+        rewind = 0.0
+        state_time = msg.get('state_time')
+        rtt        = sessions[addr]['rtt']
+        if finite_number(state_time) and abs(now - state_time) <= STATE_TIME_TOLERANCE:
+            lag = now - state_time
+        else:
+            lag = rtt / 2 if rtt else 0.0   # no usable state_time: assume the one-way delay
+        if lag > 1.0 / TICK_RATE:
+            rewind = min(lag, MAX_REWIND)
+
+        # create a new bullet heading in the shooter's direction;
+        # the record never changes, positions are derived from it
+        bullet = {
+            'id': room['next_bullet_id'],        # unique within the room
+            'player_id': player_id,              # who fired
+            'origin': origin,                    # starting coords
+            'direction': direction,              # heading
+            'created': now,                      # spawn timestamp
+            'rewind': rewind,                    # lag compensation (seconds)
+        }
+        room['next_bullet_id'] += 1
+        add_bullet(room, bullet)
+        log_event('shoot', room=room['name'], player=player_id, bullet=bullet['id'],
+                  direction=direction, rewind_ms=round(rewind * 1000, 1))
+    return True
+
+
+# ----------------
+# Start the game
+# ----------------
+@player_action('start_game')
+def handle_start_game(transport, addr, msg, player_id, room, p):
+    # require at least 2 players and all ready
+    room['game_started'] = True
+    ready_ids = [pid for pid in room['waiting_room']
+                 if room['players'][pid]['ready']]
+    if len(room['waiting_room']) >= 2 and len(ready_ids) == len(room['waiting_room']):
+        room['waiting_room'].clear()  # clear lobby
+        log_event('game_started', room=room['name'], player=player_id)
+    return True
+
+
+# ------------------
+# Player leaves game
+# ------------------
+@player_action('leave')
+def handle_leave(transport, addr, msg, player_id, room, p):
+    # delete all player data (and remove from waiting room if present)
+    remove_player(room, player_id)
+    if len(room['players']) == 0:
+        room['game_started'] = False
+    log_event('leave', room=room['name'], player=player_id)
+    return True
+
+
+@player_action('revive')
+def handle_revive(transport, addr, msg, player_id, room, p):
+    """
+    Bring the tank back with full hp at a new spawn point, stopped, and
+    tell the player where it is.
+    """
+    p['hp']     = 100
+    p['moving'] = None
+    room['moving'].discard(player_id)
+    set_player_position(room, player_id, rng.randint(100, 700), rng.randint(100, 500))
+    send_packet(transport, json.dumps({'action': 'revived', 'position': p['position']}).encode('utf-8'),
+                p['address'], 'revived')
+    log_event('revive', room=room['name'], player=player_id)
+    return True
+
+
+# ------------------------------------------------------------
+# Bundled input: sequence-numbered inputs, resent until acked
+# ------------------------------------------------------------
+@player_action('input_bundle')
+def handle_input_bundle(transport, addr, msg, player_id, room, p):
+    """
+    Queue the inputs of a bundle that are newer than the last one queued.
+    A bundle repeats recent inputs, so a lost packet is covered by the next.
+    Each new input is charged to its own rate limit class, as if it had
+    come on its own; rate limited ones are dropped. The highest sequence
+    number applied is acked after the tick's drain.
+    """
+    inputs = msg.get('inputs')
+    if not isinstance(inputs, list):
+        return False
+    for item in inputs[:MAX_BUNDLE_INPUTS]:
+        if not isinstance(item, dict):
+            continue
+        seq = item.get('seq')
+        if not isinstance(seq, int) or isinstance(seq, bool) or not isinstance(item.get('action'), str) \
+                or item['action'] not in PLAYER_HANDLERS or item['action'] in IMMEDIATE_ACTIONS:
+            continue
+        if seq <= p['input_seq']:
+            input_stats['duplicates'] += 1
+            continue
+        if not allow_datagram(addr, item['action'], clock.monotonic()):
+            p['input_seq'] = seq   # dropped, like a rate limited datagram; not charged again when resent
+            continue
+        if not enqueue_input(room, addr, dict(item, player_id=player_id)):
+            break   # queue full; the client resends these
+        p['input_seq'] = seq
+    return False
+
+
+# -------------
+# In-game chat
+# -------------
+@player_action('chat')
+def handle_chat(transport, addr, msg, player_id, room, p):
+    text = str(msg.get('message', ''))
+    if len(text) > MAX_CHAT_LENGTH:
+        text = text[:MAX_CHAT_LENGTH]
+        traffic_stats['truncated'] += 1
+    # just log chat on server
+    log_event('chat', room=room['name'], player=player_id, message=text)
+    return True
+
+
+# ---------------------------------------------------
+# Handle an incoming UDP packet from a client (player)
+# ---------------------------------------------------
+input_stats = {'queued': 0, 'coalesced': 0, 'dropped': 0, 'applied': 0, 'duplicates': 0, 'failed': 0}
+
+rate_buckets  = {}   # client address -> {'seen': time, action class: (tokens, updated)}
+traffic_stats = {
+    'oversize': 0,         # datagrams over MAX_DATAGRAM_SIZE
+    'malformed': 0,        # undecodable, or no action / bad player_id
+    'spoofed': 0,          # player actions from an address other than the player's
+    'rejected_joins': 0,   # bad room, room full or player_id in use
+    'bullet_cap': 0,       # shots over MAX_BULLETS_PER_PLAYER
+    'truncated': 0,        # chat messages cut to MAX_CHAT_LENGTH
+    'rate_limited': {cls: 0 for cls in RATE_LIMITS},
+}
+
+
+def dispatch(transport, addr, msg):
+    """
+    Run the handler registered for msg['action']. If the handler changed
+    the room, broadcast the new state right away for lobby/lifecycle
+    actions, otherwise mark the room dirty for its next scheduled send.
+    """
+    action    = msg.get('action')       # the action that the client wants to perform
+    player_id = msg.get('player_id')    # unique identifier for the player
+
+    handler = SERVER_HANDLERS.get(action)
+    if handler is not None:
+        if handler(transport, addr, msg, player_id):
+            room_id = player_rooms.get(player_id)
+            if room_id is not None:
+                broadcast_state(transport, room_id)
+                wake_room(rooms[room_id])
+        return
+
+    # all other actions require a player that is in a room
+    handler = PLAYER_HANDLERS.get(action)
+    room_id = player_rooms.get(player_id)
+    if handler is None or room_id is None:
+        return
+    room = rooms[room_id]
+    p    = room['players'][player_id]
+    if p['address'] != addr:
+        traffic_stats['spoofed'] += 1   # only the address that joined may act as this player
+        return
+    if handler(transport, addr, msg, player_id, room, p):
+        if action in IMMEDIATE_BROADCASTS:
+            broadcast_state(transport, room_id)
+        else:
+            room['dirty'] = True
+        wake_room(room)
+
+
+def allow_datagram(addr, action, now):
+    """
+    Token bucket check for one datagram from 'addr'. Each address has a
+    bucket per action class (RATE_LIMITS); state for at most
+    MAX_TRACKED_ADDRESSES addresses is kept, least recently active first out.
+    """
+    cls     = ACTION_CLASSES.get(action, 'control')
+    buckets = rate_buckets.pop(addr, None)
+    if buckets is None:
+        buckets = {}
+        while len(rate_buckets) >= MAX_TRACKED_ADDRESSES:
+            del rate_buckets[next(iter(rate_buckets))]
+    buckets['seen'] = now
+    rate_buckets[addr] = buckets   # re-inserted: most recently active last
+
+    rate, burst  = RATE_LIMITS[cls]
+    tokens, last = buckets.get(cls, (burst, now))
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens < 1:
+        buckets[cls] = (tokens, now)
+        traffic_stats['rate_limited'][cls] += 1
+        return False
+    buckets[cls] = (tokens - 1, now)
+    return True
+
+
+def prune_rate_buckets(now):
+    """
+    Forget addresses that sent nothing for RATE_LIMIT_IDLE seconds.
+    """
+    while rate_buckets:
+        addr = next(iter(rate_buckets))
+        if now - rate_buckets[addr]['seen'] < RATE_LIMIT_IDLE:
+            break
+        del rate_buckets[addr]
+
+
+def parse_message(data):
+    """
+    Decode a packet and check it names an action and a player.
+    """
+    msg = decode_message(data)
+    if msg is None:
+        return None  # ignore anything that isn't a valid message
+    # require both fields
+    player_id = msg.get('player_id')
+    if not isinstance(msg.get('action'), str) or not isinstance(player_id, str) \
+            or not 0 < len(player_id) <= MAX_PLAYER_ID_LENGTH:
+        return None
+    return msg
+
+
+def receive_datagram(addr, data, transport):
+    """
+    Entry point for every datagram: size, format and rate limit checks,
+    then accept_message. Accepted datagrams are recorded when recording.
+    """
+    if len(data) > MAX_DATAGRAM_SIZE:
+        traffic_stats['oversize'] += 1
+        count_received('oversize', len(data))
+        return
+    msg = parse_message(data)
+    if msg is None:
+        traffic_stats['malformed'] += 1
+        count_received('malformed', len(data))
+        return
+    known = msg['action'] in SERVER_HANDLERS or msg['action'] in PLAYER_HANDLERS
+    count_received(msg['action'] if known else 'unknown', len(data))
+    wall, now = time.time(), time.monotonic()
+    if not allow_datagram(addr, msg['action'], now):
+        return
+    if recorder['file'] is not None:
+        record_event(RECORD_DATAGRAM, RECORD_TIMES.pack(wall, now) + pack_frame(addr, data))
+    # handlers see the arrival time, as they will in a replay
+    clock.pin(wall, now)
+    try:
+        accept_message(transport, addr, msg, now)
+    finally:
+        clock.unpin()
+
+
+def accept_message(transport, addr, msg, now):
+    """
+    Apply a message that passed the checks. Room management and
+    bookkeeping (pong, ack) run right away. Everything a player does in
+    a room goes into that room's input queue and is applied at the start
+    of the next tick, where only the latest 'move' per player counts.
+    """
+    session = sessions.get(addr)
+    if session is not None:
+        session['last_seen'] = now   # any packet proves the client is alive
+    action  = msg['action']
+    room_id = player_rooms.get(msg['player_id'])
+    if action in SERVER_HANDLERS or action in IMMEDIATE_ACTIONS or room_id is None:
+        dispatch(transport, addr, msg)
+        return
+    room = rooms[room_id]
+    if room['players'][msg['player_id']]['address'] != addr:
+        traffic_stats['spoofed'] += 1   # checked here too, so it can't displace a queued move
+        return
+    enqueue_input(room, addr, msg)
 
-# ------------------------
-# Server timing parameters
-# ------------------------
-TICK_RATE     = 60        # how many game updates per second
-PING_INTERVAL = 10        # how often server sends ping messages (seconds)
-PONG_TIMEOUT  = 30        # how long to wait for a pong before disconnecting (seconds)
 
+def enqueue_input(room, addr, msg):
+    """
+    Queue an input for the next tick. Returns False if the queue is full.
+    """
+    inputs = room['inputs']
+    if msg['action'] == 'move':
+        i = room['pending_moves'].get(msg['player_id'])
+        if i is not None:
+            # a newer move replaces the queued one (it keeps the older slot)
+            inputs[i] = (addr, msg)
+            input_stats['coalesced'] += 1
+            return True
+    if len(inputs) >= INPUT_QUEUE_SIZE:
+        input_stats['dropped'] += 1
+        return False
+    if msg['action'] == 'move':
+        room['pending_moves'][msg['player_id']] = len(inputs)
+    inputs.append((addr, msg))
+    input_stats['queued'] += 1
+    wake_room(room)
+    return True
 
-# ----------------------------------------
-# Pre-created rooms (no dynamic create/delete)
-# ----------------------------------------
-def create_room(name):
-    return {
-        'name': name,
-        'waiting_room': [],
-        'players': {},
-        'bullets': [],
-        'game_started': False
-    }
 
-rooms = {
-    'room_1': create_room('room_1'),
-    'room_2': create_room('room_2'),
-    'room_3': create_room('room_3'),
+def drain_inputs(transport, room):
+    """
+    Apply the inputs a room received since the last tick, in arrival order.
+    """
+    inputs = room['inputs']
+    if not inputs:
+        return
+    room['inputs']        = []
+    room['pending_moves'] = {}
+    acks = {}   # player_id -> (addr, highest bundled seq applied)
+    for addr, msg in inputs:
+        try:
+            dispatch(transport, addr, msg)
+        except Exception as exc:
+            # a malformed input is dropped; it must not stop the tick loop for every room
+            input_stats['failed'] += 1
+            log_event('input_failed', 'error', room=room['name'], player=msg.get('player_id'),
+                      action=msg.get('action'), error=repr(exc))
+            continue
+        input_stats['applied'] += 1
+        seq = msg.get('seq')
+        if isinstance(seq, int) and not isinstance(seq, bool):   # plain datagrams may carry any 'seq'
+            _, acked = acks.get(msg['player_id'], (None, 0))
+            acks[msg['player_id']] = (addr, max(acked, seq))
+
+    for pid, (addr, seq) in acks.items():
+        if player_rooms.get(pid) == room['name']:
+            send_packet(transport, json.dumps({'action': 'input_ack', 'seq': seq}).encode('utf-8'), addr,
+                        'input_ack')
+
+    # server-side movement: where each tank was when its latest move_input
+    # took effect, so the client can correct its prediction
+    for pid, seq in room['move_acks'].items():
+        p = room['players'].get(pid)
+        if p is not None:
+            send_packet(transport, json.dumps({
+                'action': 'move_ack', 'move_seq': seq, 'position': p['position']}).encode('utf-8'),
+                p['address'], 'move_ack')
+    room['move_acks'] = {}
+
+
+# -------------------------------------------------------
+# Game update loop: move bullets, detect collisions, etc.
+# -------------------------------------------------------
+current_tick = 0   # number of simulation ticks run since the server started
+
+tick_stats = {
+    'ticks': 0,                                          # ticks simulated
+    'loops': 0,                                          # scheduler wakeups
+    'overruns': 0,                                       # wakeups whose work exceeded one tick
+    'dropped': 0,                                        # ticks skipped after a stall
+    'max_ms': 0.0,                                       # slowest wakeup
+    'histogram': [0] * (len(TICK_HISTOGRAM_BUCKETS) + 1),  # wakeup durations, last bucket = overflow
+    'recent': [],                                        # wakeup durations (ms) since the last summary
 }
+TICK_SAMPLES = 10000   # wakeup durations kept between summaries for the percentiles
+
 
-# ---------------------------------------
-# Utility: print full game state on event
-# ---------------------------------------
-def print_state(event: str):
+def record_tick_duration(duration):
     """
-    Print the given event description along with the entire game_state.
+    Add one scheduler wakeup that took 'duration' seconds to tick_stats.
     """
-    timestamp = time.strftime('%H:%M:%S', time.localtime())  # human-readable time
-    print(f"\n[{timestamp}] {event}")                         # header line
-    # pretty-print the game_state JSON for debugging
-    print(json.dumps(rooms, indent=2, ensure_ascii=False), "\n")
+    ms = duration * 1000
+    tick_stats['loops'] += 1
+    if len(tick_stats['recent']) < TICK_SAMPLES:
+        tick_stats['recent'].append(ms)
+    tick_stats['max_ms'] = max(tick_stats['max_ms'], ms)
+    if duration > 1.0 / TICK_RATE:
+        tick_stats['overruns'] += 1
+    for i, bound in enumerate(TICK_HISTOGRAM_BUCKETS):
+        if ms <= bound:
+            tick_stats['histogram'][i] += 1
+            break
+    else:
+        tick_stats['histogram'][-1] += 1
 
 
-# -----------------------------------------------------
-# Broadcast the full game state to all connected players
-# -----------------------------------------------------
-async def broadcast_state(transport, room_id):
+def log_tick_stats(ticks, elapsed):
     """
-    Send an 'update_state' message containing game_state to every player.
+    Log a summary of tick timings: the rate achieved by the last 'ticks'
+    ticks over 'elapsed' seconds and their duration percentiles, plus the
+    running totals.
     """
-    message = {
-        'action': 'update_state',
-        'game_state': rooms[room_id],
-        'timestamp': time.time(),
-    }
-    data = json.dumps(message).encode('utf-8')  # encode to bytes
-    # send the update to each player's stored address
-    for pid, info in list(rooms[room_id]['players'].items()):
-        transport.sendto(data, info['address'])
+    rtts   = sorted(session['rtt'] for session in sessions.values() if session['rtt'] is not None)
+    recent = sorted(tick_stats['recent'])
+    depths = heapq.nlargest(5, ((session.get('queue_max', 0), session['player_id']) for session in sessions.values()))
+    tick_stats['recent'] = []
+    log_event('tick_stats',
+              rate=round(ticks / elapsed, 2),
+              percentiles_ms={str(q): round(recent[min(len(recent) - 1, int(len(recent) * q / 100))], 3)
+                              for q in (50, 90, 99)} if recent else None,
+              overruns=tick_stats['overruns'],
+              dropped=tick_stats['dropped'],
+              max_ms=round(tick_stats['max_ms'], 3),
+              buckets_ms=list(TICK_HISTOGRAM_BUCKETS),
+              histogram=list(tick_stats['histogram']),
+              log=dict(log_stats),
+              input=dict(input_stats),
+              sessions=len(sessions),
+              active_rooms=len(active_rooms),
+              egress=dict(egress_stats),
+              queue_depth={'buckets': list(DEPTH_BUCKETS), 'histogram': list(histograms['queue_depth']['counts']),
+                           'deepest': {pid: depth for depth, pid in depths if depth}},
+              rtt_ms={'median': round(rtts[len(rtts) // 2] * 1000, 1),
+                      'max': round(rtts[-1] * 1000, 1)} if rtts else None,
+              traffic={**traffic_stats, 'rate_limited': dict(traffic_stats['rate_limited'])})
 
 
-# ---------------------------------------------------
-# Handle an incoming UDP packet from a client (player)
-# ---------------------------------------------------
-async def handle_client(addr, data, transport):
+def simulate_room(game_state, now, dt):
     """
-    Parse a JSON message from a client at address 'addr' and update game_state.
-    After handling certain actions, broadcast the updated state to all players.
+    Advance one room from 'now - dt' to 'now': expire bullets, drop the
+    ones that left the map and apply hits. Large rooms use the NumPy
+    engine when it is available; both engines give identical results.
     """
-    try:
-        msg = json.loads(data.decode('utf-8'))  # decode JSON
-    except json.JSONDecodeError:
-        return  # ignore non-JSON
+    if np is not None and USE_NUMPY and len(game_state['bullets']) >= NUMPY_MIN_BULLETS:
+        simulate_bullets_numpy(game_state, now, dt)
+    else:
+        simulate_bullets(game_state, now, dt)
 
-    action    = msg.get('action')       # the action that the client wants to perform
-    player_id = msg.get('player_id')    # unique identifier for the player
-    room_name = msg.get('room_name')    # the room name (used for create_room and join_room_by_name actions)
 
-    # require both fields
-    if not action or not player_id:
-        return
+def apply_hit(game_state, b, pid):
+    """
+    Bullet 'b' hit player 'pid': apply damage and record the event.
+    """
+    info = game_state['players'][pid]
+    info['hp'] -= BULLET_DAMAGE
+    game_state['events'].append({
+        'type': 'hit',
+        'bullet': b['id'],
+        'player_id': pid,
+        'hp': info['hp'],
+    })
+    log_event('destroyed' if info['hp'] <= 0 else 'hit', room=game_state['name'], player=pid,
+              shooter=b['player_id'], bullet=b['id'], damage=BULLET_DAMAGE, hp=info['hp'])
 
-    # ------------------------------------------------------------
-    # Figure out which static room (room_1/2/3) this player is in
-    # ------------------------------------------------------------
-    current_room = None
-    game_state   = None
-    for rn, st in rooms.items():
-        if player_id in st['players']:
-            current_room = rn
-            game_state   = st
-            break
 
-    # -------------------
-    # Handle 'pong' reply
-    # -------------------
-    if action == 'pong':
-        # only update if they’re already in a room
-        if game_state:
-            game_state['players'][player_id]['last_pong'] = time.time()
-        return  # no broadcast for pong    
-
-    # ----------------------------------------------------------------
-    # Determine which static room (room_1/2/3) this player is in, if any
-    # ----------------------------------------------------------------
-    current_room = None
-    game_state   = None
-    for rn, st in rooms.items():
-        if player_id in st['players']:
-            current_room = rn
-            game_state   = st
-            break
+def simulate_bullets(game_state, now, dt):
+    """
+    Plain-Python bullet engine. Each bullet is swept along the path it
+    covered during the tick, so it can't skip over a tank, and only tanks
+    in nearby grid cells are tested.
+    """
+    players     = game_state['players']
+    new_bullets = []   # rebuild list of bullets that survive
+    for b in game_state['bullets']:
+        if b['created'] > now:
+            new_bullets.append(b)   # fired after this tick's time; it starts moving next tick
+            continue
+        # the part of this tick the bullet was alive for
+        start = max(b['created'], now - dt)
+        end   = min(now, b['created'] + BULLET_LIFETIME)
+        if end < start:
+            continue  # lifetime expired before this tick
 
-    # For any action _other than_ join_room, we need a valid current_room
-    if action != 'join_room':
-        if not current_room:
-            return
-        # game_state was already set above
-
-    # -------------------------------------
-    # Handle new player joining the waiting room
-    # -------------------------------------
-    if action == 'join_room':
-        # 1) Validate room_name
-        room_name = msg.get('room_name')
-        if not room_name or room_name not in rooms:
-            transport.sendto(json.dumps({
-                'action': 'join_room_response',
-                'success': False,
-                'error': 'invalid or missing room_name'
-            }).encode('utf-8'), addr)
-            return
+        # positions follow from the spawn record, not from tick counting
+        x0, y0 = bullet_position(b, start)
+        x1, y1 = bullet_position(b, end)
 
-        # 2) Remove from any previous room
-        for old_name, old_room in rooms.items():
-            if player_id in old_room['players']:
-                del old_room['players'][player_id]
-            if player_id in old_room['waiting_room']:
-                old_room['waiting_room'].remove(player_id)
-            if old_name != room_name:
-                await broadcast_state(transport, old_name)
-
-        # 3) Add (or reconnect) into the new room
-        new_room = rooms[room_name]
-        if player_id not in new_room['players']:
-            new_room['players'][player_id] = {
-                'ready': False,
-                'position': {'x': random.randint(100, 700), 'y': random.randint(100, 500)},
-                'direction': "up",
-                'hp': 100,
-                'address': addr,
-                'last_pong': time.time(),
-                'skin': random.randint(1, 4)
-            }
-            if not new_room['game_started']:
-                new_room['waiting_room'].append(player_id)
-            else:
-                new_room['players'][player_id]['ready'] = True
-            print_state(f"Player '{player_id}' joined {room_name}")
+        # find the first tank the bullet touches along its path (excluding the shooter);
+        # lag-compensated bullets see the tanks where their shooter saw them
+        if b.get('rewind'):
+            hit_pid = rewound_hit(game_state, b, x0, y0, x1, y1, start - b['rewind'])
         else:
-            # reconnecting
-            p = new_room['players'][player_id]
-            p['address']   = addr
-            p['last_pong'] = time.time()
+            hit_t, hit_pid = None, None
+            for pid in players_near_segment(game_state['grid'], x0, y0, x1, y1):
+                info = players[pid]
+                # skip shooter and dead players
+                if pid == b['player_id'] or info['hp'] <= 0:
+                    continue
+                t = segment_hit_time(x0, y0, x1, y1,
+                                     info['position']['x'], info['position']['y'], PLAYER_RADIUS)
+                if t is not None and (hit_t is None or (t, pid) < (hit_t, hit_pid)):
+                    hit_t, hit_pid = t, pid
 
-        # 4) Confirm join and broadcast new state
-        transport.sendto(json.dumps({
-            'action': 'join_room_response',
-            'success': True,
-            'room_name': room_name
-        }).encode('utf-8'), addr)
-        await broadcast_state(transport, room_name)
-        return
-    # ------------------------------------
-    # All other actions require a known player
-    # ------------------------------------
-    if player_id not in game_state['players']:
-        return  # ignore unknown players
-    p = game_state['players'][player_id]  # shorthand
-
-    # -------------------
-    # Player indicates ready
-    # -------------------
-    if action == 'set_ready':
-        # mark ready and give initial spawn position/direction
-        p.update({
-            'ready': True,
-        })
-        print_state(f"Player '{player_id}' set ready")
-
-    # -----------------
-    # Player movement
-    # -----------------
-    elif action == 'move':
-        pos  = msg.get('position')    # expected dict with 'x' and 'y'
-        dir_ = msg.get('direction')   # expected string
-        # only move if player is alive and sent valid data
-        if pos and dir_ and p['hp'] > 0:
-            # clamp within map bounds
-            x = max(0, min(MAP_WIDTH, pos.get('x', 0)))
-            y = max(0, min(MAP_HEIGHT, pos.get('y', 0)))
-            p['position']  = {'x': x, 'y': y}
-            p['direction'] = dir_
-            print_state(f"Player '{player_id}' moved to {p['position']}")
-
-    # -----------------
-    # Player shooting
-    # -----------------
-    elif action == 'shoot':
-        # only shoot if alive and has a valid position
-        if p['position'] and p['hp'] > 0:
-            # create a new bullet at player's position heading in player's direction
-            bullet = {
-                'player_id': player_id,              # who fired
-                'position': p['position'].copy(),    # starting coords
-                'direction': p['direction'],         # heading
-                'created': time.time()               # spawn timestamp
-            }
-            game_state['bullets'].append(bullet)
-            print_state(f"Player '{player_id}' shot a bullet (dir={p['direction']})")
-
-    # ----------------
-    # Start the game
-    # ----------------
-    elif action == 'start_game':
-        # require at least 2 players and all ready
-        game_state['game_started'] = True
-        ready_ids = [pid for pid in game_state['waiting_room']
-                     if game_state['players'][pid]['ready']]
-        if len(game_state['waiting_room']) >= 2 and len(ready_ids) == len(game_state['waiting_room']):
-            game_state['waiting_room'].clear()  # clear lobby
-            print_state("Game started")
-
-    # ------------------
-    # Player leaves game
-    # ------------------
-    elif action == 'leave':
-        # remove from waiting room if present
-        if player_id in game_state['waiting_room']:
-            game_state['waiting_room'].remove(player_id)
-        # delete all player data
-        del game_state['players'][player_id]
-        if len(game_state['players']) == 0:
-            game_state['game_started'] = False
-        print_state(f"Player '{player_id}' left the game")
-    
-    elif action == 'revive':
-        p.update({
-            'hp': 100,
-        })
-        print_state(f"Revived '{player_id}'")
-
-    # -------------
-    # In-game chat
-    # -------------
-    elif action == 'chat':
-        text = msg.get('message', '')
-        # just log chat on server
-        print(f"[chat] {player_id}@{current_room}: {text}")
-
-    # ----------------------------------
-    # After handling any of the above,
-    # broadcast updated game state
-    # ----------------------------------
-    await broadcast_state(transport, current_room)
+        if hit_pid is not None:
+            apply_hit(game_state, b, hit_pid)
+            continue  # the bullet stops on the first hit
+
+        # remove bullet if its lifetime expired
+        if now - b['created'] > BULLET_LIFETIME:
+            continue
+        # discard if outside map
+        if not (0 <= x1 <= MAP_WIDTH and 0 <= y1 <= MAP_HEIGHT):
+            continue
+        # not hit anyone, keep bullet alive
+        new_bullets.append(b)
+
+    # replace old bullet list (the NumPy mirror is rebuilt if it is needed again)
+    game_state['bullets']       = new_bullets
+    game_state['bullet_arrays'] = None
+
+
+def sweep_tanks(x0, y0, x1, y1, px, py):
+    """
+    segment_hit_time() for every bullet path (rows: segment end point
+    arrays) against every tank at (px, py) (columns). Returns the hit
+    fractions and where they are valid.
+    """
+    dx, dy = (x1 - x0)[:, None], (y1 - y0)[:, None]
+    fx, fy = x0[:, None] - px, y0[:, None] - py
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c    = fx * fx + fy * fy - PLAYER_RADIUS * PLAYER_RADIUS
+        a    = dx * dx + dy * dy
+        b    = 2 * (fx * dx + fy * dy)
+        disc = b * b - 4 * a * c
+        t    = (-b - np.sqrt(disc)) / (2 * a)
+    inside = c <= 0
+    t      = np.where(inside, 0.0, t)
+    return t, inside | ((a != 0) & (disc >= 0) & (t >= 0) & (t <= 1))
+
+
+def simulate_bullets_numpy(game_state, now, dt):
+    """
+    NumPy bullet engine: the same sweep as simulate_bullets(), done for
+    every bullet against every tank at once. Hits are then applied in
+    bullet order, so a tank destroyed by an earlier bullet stops
+    counting for later ones, exactly as in the plain loop.
+    """
+    bullets = game_state['bullets']
+    arrays  = game_state['bullet_arrays']
+    if arrays is None or arrays.size != len(bullets):
+        arrays = game_state['bullet_arrays'] = BulletArrays(bullets)
+    n       = arrays.size
+    created = arrays.created[:n]
+
+    # the part of this tick each bullet was alive for
+    start = np.maximum(created, now - dt)
+    end   = np.minimum(now, created + BULLET_LIFETIME)
+    unborn = created > now   # fired after this tick's time; they start moving next tick
+    alive  = (end >= start) & ~unborn
+    x0, y0 = arrays.positions(start)
+    x1, y1 = arrays.positions(end)
+
+    players    = game_state['players']
+    lagged     = alive & (arrays.rewind[:n] > 0)   # tested against past positions
+    candidates = {}   # bullet index -> [(hit fraction, player id)] before the hp check
+
+    # bullets without lag compensation: every one against every tank as it is now
+    current = np.flatnonzero(alive & ~lagged)
+    if current.size:
+        pids = list(players)
+        px = np.array([players[pid]['position']['x'] for pid in pids], float)
+        py = np.array([players[pid]['position']['y'] for pid in pids], float)
+        t, touch = sweep_tanks(x0[current], y0[current], x1[current], y1[current], px, py)
+        nums  = np.array([assign_player_num(pid) for pid in pids], np.int64)
+        live  = np.array([players[pid]['hp'] > 0 for pid in pids], bool)
+        touch &= live & (arrays.owner[current][:, None] != nums)
+        for row in np.flatnonzero(touch.any(axis=1)).tolist():
+            candidates[int(current[row])] = [(t[row, j], pids[j]) for j in np.flatnonzero(touch[row]).tolist()]
+
+    # lag-compensated bullets: grouped by the history frame each one
+    # rewinds to (as history_frame does), then against that frame's tanks
+    rewound = np.flatnonzero(lagged)
+    history = game_state['history']
+    if rewound.size and history:
+        times  = np.array([frame[0] for frame in history], float)
+        when   = start[rewound] - arrays.rewind[:n][rewound]
+        frames = np.maximum(np.searchsorted(times, when, side='right') - 1, 0)
+        for f in np.unique(frames).tolist():
+            rows = rewound[frames == f]
+            pids = [pid for pid in history[f][1] if pid in players and players[pid]['hp'] > 0]
+            if not pids:
+                continue
+            px, py = np.array([history[f][1][pid] for pid in pids], float).T
+            t, touch = sweep_tanks(x0[rows], y0[rows], x1[rows], y1[rows], px, py)
+            nums   = np.array([assign_player_num(pid) for pid in pids], np.int64)
+            touch &= arrays.owner[rows][:, None] != nums
+            for row in np.flatnonzero(touch.any(axis=1)).tolist():
+                candidates[int(rows[row])] = [(t[row, j], pids[j]) for j in np.flatnonzero(touch[row]).tolist()]
+
+    # apply hits in bullet order; earlier hits may kill a tank for later bullets
+    hit = np.zeros(n, bool)
+    for i in sorted(candidates):
+        remaining = [(t, pid) for t, pid in candidates[i] if players[pid]['hp'] > 0]
+        if remaining:
+            apply_hit(game_state, bullets[i], min(remaining)[1])
+            hit[i] = True
+
+    # keep bullets that hit nothing, are still within their lifetime and on the map
+    keep = unborn | (alive & ~hit & ((now - created) <= BULLET_LIFETIME)
+                     & (x1 >= 0) & (x1 <= MAP_WIDTH) & (y1 >= 0) & (y1 <= MAP_HEIGHT))
+    game_state['bullets'] = list(itertools.compress(bullets, keep.tolist()))
+    arrays.keep(keep)
+
+
+def run_tick(transport, now, step):
+    """
+    One simulation tick of every active room, at wall-clock time 'now':
+    apply the queued inputs, move tanks and bullets.
+    """
+    global current_tick
+    wake_due_rooms(current_tick)
+    for game_state in list(active_rooms.values()):
+        room_started = time.perf_counter()
+        drain_inputs(transport, game_state)
+        drained = time.perf_counter()
+        if game_state['moving']:
+            move_tanks(game_state, step)
+        record_positions(game_state, now)
+        moved = time.perf_counter()
+        if game_state['bullets']:
+            game_state['dirty'] = True   # bullets move (or expire) every tick
+            simulate_room(game_state, now, step)
+        simulated = time.perf_counter()
+        tick_phases['input']      += drained - room_started
+        tick_phases['simulation'] += moved - drained
+        tick_phases['collision']  += simulated - moved
+        metrics['room_seconds'][game_state['name']] += simulated - room_started
+    current_tick += 1
+    tick_stats['ticks'] += 1
+
+
+def broadcast_rooms(transport, refresh_every):
+    """
+    Broadcast the active rooms that changed, each at its own send rate
+    (or every 'refresh_every' ticks). Rooms with nothing left to do go
+    dormant.
+    """
+    for room_id, room in list(active_rooms.items()):
+        since = current_tick - room['last_sent']
+        if room['players'] and since >= max(1, round(TICK_RATE / room['send_rate'])) \
+                and (room['dirty'] or since >= refresh_every):
+            broadcast_state(transport, room_id)
+        if not room['players']:
+            room['dirty'] = False   # nobody to send the change to
+        if not (room['inputs'] or room['bullets'] or room['dirty'] or room['moving']):
+            sleep_room(room, room['last_sent'] + refresh_every if room['players'] else None)
 
 
-# -------------------------------------------------------
-# Game update loop: move bullets, detect collisions, etc.
-# -------------------------------------------------------
 async def game_tick(transport):
     """
-    Runs at TICK_RATE Hz. Moves each bullet, checks for
-    out-of-bounds or lifetime expiration, and detects hits.
+    Fixed-timestep loop. Tick n simulates the world at start + n/TICK_RATE
+    on the monotonic clock, so the rate doesn't drift with the time spent
+    doing the work. Ticks missed during a stall are run back-to-back (up
+    to MAX_CATCHUP_TICKS). A room's state is broadcast at its own
+    send_rate, and only when it changed (or STATE_REFRESH_INTERVAL passed).
+    Only active rooms are visited; see wake_room and sleep_room.
+    While a tick runs, the game clock reads the tick's time.
     """
-    interval = 1.0 / TICK_RATE  # seconds per tick
+    step          = 1.0 / TICK_RATE                           # seconds per tick
+    refresh_every = max(1, round(STATE_REFRESH_INTERVAL * TICK_RATE))   # ticks between resends
+    # simulation times are reported in wall-clock seconds, like bullet 'created'
+    wall_offset = time.time() - time.monotonic()
+    next_tick   = time.monotonic()
+    last_stats  = next_tick
+    stats_ticks = tick_stats['ticks']
     while True:
-        now = time.time()            # current time for lifetime checks
-        new_bullets = []             # rebuild list of bullets that survive
-        for room_id, game_state in rooms.items():
-
-            # process each active bullet
-            for b in game_state['bullets']:
-                # remove bullet if its lifetime expired
-                if now - b['created'] > BULLET_LIFETIME:
-                    continue
+        started = time.monotonic()
+        for phase in TICK_PHASES:
+            tick_phases[phase] = 0.0
 
-                # calculate movement for this tick
-                distance = BULLET_SPEED * interval
-                dx = dy = 0
-                if   b['direction'] == 'up':    dy = -distance
-                elif b['direction'] == 'down':  dy =  distance
-                elif b['direction'] == 'left':  dx = -distance
-                else:                            dx =  distance
+        # how many ticks are due; after a long stall drop all but the last few
+        due = int((started - next_tick) / step) + 1
+        if due > MAX_CATCHUP_TICKS:
+            tick_stats['dropped'] += due - MAX_CATCHUP_TICKS
+            next_tick += (due - MAX_CATCHUP_TICKS) * step
+            due = MAX_CATCHUP_TICKS
 
-                # update bullet position
-                b['position']['x'] += dx
-                b['position']['y'] += dy
+        for _ in range(due):
+            now = next_tick + wall_offset
+            clock.pin(now, next_tick)
+            if recorder['file'] is not None:
+                record_event(RECORD_TICK, RECORD_TICK_TIMES.pack(current_tick, now, next_tick))
+            run_tick(transport, now, step)
+            next_tick += step
+        clock.unpin()
 
-                x, y = b['position']['x'], b['position']['y']
+        if recorder['file'] is not None:
+            record_event(RECORD_BROADCAST, RECORD_TIMES.pack(time.time(), time.monotonic()))
+        broadcast_rooms(transport, refresh_every)
 
-                # discard if outside map
-                if not (0 <= x <= MAP_WIDTH and 0 <= y <= MAP_HEIGHT):
-                    continue
+        # everything this wakeup queued goes out in one batch
+        flushing = time.perf_counter()
+        flush_egress()
+        tick_phases['send'] += time.perf_counter() - flushing
+
+        finished = time.monotonic()
+        record_tick_duration(finished - started)
+        for phase, seconds in tick_phases.items():
+            observe(histograms['phase'][phase], seconds)
+        if finished - last_stats >= TICK_STATS_INTERVAL:
+            log_tick_stats(tick_stats['ticks'] - stats_ticks, finished - last_stats)
+            stats_ticks = tick_stats['ticks']
+            last_stats  = finished
+        if recorder['file'] is not None and recorder['size'] >= RECORD_SEGMENT_BYTES:
+            rotate_recording()
 
-                # check collision with any player (excluding the shooter)
-                hit = False
-                for pid, info in game_state['players'].items():
-                    # skip shooter, dead players, or unspawned
-                    if pid == b['player_id'] or info['hp'] <= 0 or not info['position']:
-                        continue
-                    px, py = info['position']['x'], info['position']['y']
-                    # if distance <= PLAYER_RADIUS => hit
-                    if math.hypot(px - x, py - y) <= PLAYER_RADIUS:
-                        # apply damage
-                        info['hp'] -= BULLET_DAMAGE
-                        hit = True
-                        if info['hp'] <= 0:
-                            print_state(f"Player '{pid}' was destroyed by '{b['player_id']}'")
-                        else:
-                            print_state(f"Player '{pid}' took {BULLET_DAMAGE} damage (hp={info['hp']})")
-                        break  # bullet stops on first hit
-
-                # if not hit anyone, keep bullet alive
-                if not hit:
-                    new_bullets.append(b)
-
-            # replace old bullet list
-            game_state['bullets'] = new_bullets.copy()
-            new_bullets.clear()
-
-            # broadcast updated bullets (and any hp changes)
-            await broadcast_state(transport, room_id)
-
-        # wait until next tick
-        await asyncio.sleep(interval)
+        # wait until the next tick is due
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
 
 
 # ------------------------------------------------------
 # Ping loop: detect disconnected clients by heartbeat
 # ------------------------------------------------------
+def expire_session(addr):
+    """
+    The player at 'addr' stayed silent for PONG_TIMEOUT: remove it.
+    """
+    pid     = sessions[addr]['player_id']
+    room_id = player_rooms[pid]
+    # delete player data (and remove from lobby if there)
+    remove_player(rooms[room_id], pid)
+    rooms[room_id]['dirty'] = True
+    wake_room(rooms[room_id])
+    log_event('timeout', room=room_id, player=pid)
+
+
 async def ping_task(transport):
     """
-    Every PING_INTERVAL seconds:
-    1) send {'action':'ping'} to each player
-    2) remove any player who hasn't responded (last_pong) within PONG_TIMEOUT
+    Heartbeat timer wheel. Every PING_INTERVAL / HEARTBEAT_SLOTS seconds
+    the next slot is visited: each session in it that has been silent for
+    PONG_TIMEOUT is expired, the others get a ping. Every session is
+    visited once per PING_INTERVAL, and the pings are spread evenly over
+    the interval instead of going out in one burst.
     """
-    while True:
-        now = time.time()
-        ping_msg = json.dumps({'action': 'ping'}).encode('utf-8')
-        for room_id, game_state in rooms.items():
-            # send ping to every player
-            for pid, info in list(game_state['players'].items()):
-                transport.sendto(ping_msg, info['address'])
-
-            # remove inactive players
-            cutoff = now - PONG_TIMEOUT
-            for pid, info in list(game_state['players'].items()):
-                if info['last_pong'] < cutoff:
-                    # if in waiting room, remove from lobby
-                    if pid in game_state['waiting_room']:
-                        game_state['waiting_room'].remove(pid)
-                    # delete player data
-                    del game_state['players'][pid]
-                    print_state(f"Player '{pid}' disconnected due to timeout")
-        await asyncio.sleep(PING_INTERVAL)
+    ping_msg  = {fmt: encode_message({'action': 'ping'}, fmt) for fmt in (WIRE_JSON, WIRE_BINARY)}
+    step      = PING_INTERVAL / HEARTBEAT_SLOTS
+    next_step = time.monotonic()
+    for slot in itertools.cycle(range(HEARTBEAT_SLOTS)):
+        now = clock.monotonic()
+        for addr in list(heartbeat_wheel[slot]):
+            session = sessions[addr]
+            expired = now - session['last_seen'] > PONG_TIMEOUT
+            if recorder['file'] is not None:
+                record_event(RECORD_TIMEOUT if expired else RECORD_PING,
+                             RECORD_TIMES.pack(clock.time(), now) + pack_frame(addr, b''))
+            if expired:
+                expire_session(addr)
+                continue
+            room = rooms[player_rooms[session['player_id']]]
+            send_packet(transport, ping_msg[room['players'][session['player_id']]['wire']], addr, 'ping')
+            session['ping_sent'] = now
+        next_step += step
+        await asyncio.sleep(max(0.0, next_step - time.monotonic()))
 
 
 # ------------------------------------------
@@ -388,37 +2426,768 @@ class GameServerProtocol(asyncio.DatagramProtocol):
         """
         self.transport = transport
         sockname = transport.get_extra_info('sockname')  # (host, port)
-        print(f"Server listening on {sockname}")
+        log_event('listening', address=list(sockname))
 
     def datagram_received(self, data, addr):
         """
         Called whenever a UDP packet arrives.
-        Spawns a task to handle it asynchronously.
         """
-        asyncio.create_task(handle_client(addr, data, self.transport))
+        receive_datagram(addr, data, self.transport)
+
+
+# -----------------------------------------------------------------
+# Sharding: rooms spread over worker processes (--workers N).
+# The front process owns the UDP socket and forwards each datagram to
+# the worker that owns the room, over a Unix datagram socket. Workers
+# share the UDP socket and send their replies on it directly.
+# -----------------------------------------------------------------
+shard_index = 0      # which worker this process is
+shard_count = 1      # number of workers (1 = a single process does everything)
+front_link  = None   # worker: the socket to the front process (None when not sharded)
+
+FRAME_HEADER = struct.Struct('<HH')   # host length, port; then host, then the datagram
+front_stats  = {'forwarded': 0, 'dropped': 0, 'unrouted': 0}
+
+
+def notify_front(event, **fields):
+    """
+    Tell the front process about a change it routes by (workers only).
+    """
+    if front_link is None:
+        return
+    try:
+        front_link.send(json.dumps(dict(fields, event=event)).encode('utf-8'))
+    except (BlockingIOError, InterruptedError):
+        log_event('notify_dropped', 'warning', event=event)
+
+
+def assign_rooms(names, count):
+    """
+    Spread the rooms that exist at startup over 'count' workers,
+    round-robin in order. Rooms created later go to the worker with the
+    fewest rooms (see FrontProtocol).
+    """
+    return {name: i % count for i, name in enumerate(names)}
+
+
+def pack_frame(addr, data):
+    host = addr[0].encode('ascii')
+    return FRAME_HEADER.pack(len(host), addr[1]) + host + data
+
+
+def unpack_frame(frame):
+    length, port = FRAME_HEADER.unpack_from(frame)
+    start = FRAME_HEADER.size
+    return (frame[start:start + length].decode('ascii'), port), frame[start + length:]
+
+
+class SocketSender:
+    """
+    Stand-in for the UDP transport in a worker: sends straight to the
+    shared socket and drops the datagram if the socket buffer is full.
+    """
+    def __init__(self, sock):
+        self.sock    = sock
+        self.dropped = 0
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1
+
+    def get_extra_info(self, name, default=None):
+        if name == 'sockname':
+            return self.sock.getsockname()
+        if name == 'socket':
+            return self.sock
+        return default
+
+
+class WorkerInboxProtocol(asyncio.DatagramProtocol):
+    """
+    Receives datagrams forwarded by the front process.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, frame, _):
+        addr, data = unpack_frame(frame)
+        receive_datagram(addr, data, self.transport)
+
+
+class FrontProtocol(asyncio.DatagramProtocol):
+    """
+    UDP front end: routes each datagram to the worker owning its room.
+    Binary packets are routed by player number. JSON packets are routed
+    by the sender's address, which is learned from join_room. Room
+    management messages are routed by room name, and list_rooms goes to
+    every worker. A join into another worker's room only moves the
+    address once that worker reports the join succeeded. Each room
+    belongs to the worker it was assigned to when it was created.
+    """
+    def __init__(self, inboxes):
+        self.inboxes  = inboxes
+        self.routes   = {}                                  # client address -> worker index
+        self.owners   = assign_rooms(rooms, len(inboxes))   # room name -> worker index
+        self.creating = set()                               # rooms assigned, create_room not yet confirmed
+
+    def connection_made(self, transport):
+        log_event('listening', address=list(transport.get_extra_info('sockname')),
+                  workers=len(self.inboxes))
+
+    def datagram_received(self, data, addr):
+        if len(data) > MAX_DATAGRAM_SIZE:
+            traffic_stats['oversize'] += 1
+            return
+        if wire.is_binary(data):
+            if len(data) < wire.HEADER.size + wire.PLAYER_NUM.size:
+                return
+            (num,) = wire.PLAYER_NUM.unpack_from(data, wire.HEADER.size)
+            targets = [(num - 1) % shard_count]
+        else:
+            worker = self.routes.get(addr)
+            # only room messages (or unknown senders) need a JSON parse here
+            targets = self.route_json(data, addr, worker) if worker is None or b'_room' in data else [worker]
+        if not targets:
+            front_stats['unrouted'] += 1
+            return
+        for i in targets:
+            self.forward(i, addr, data)
+
+    def forward(self, worker, addr, data):
+        try:
+            self.inboxes[worker].send(pack_frame(addr, data))
+            front_stats['forwarded'] += 1
+        except (BlockingIOError, InterruptedError):
+            front_stats['dropped'] += 1
+
+    def route_json(self, data, addr, worker):
+        msg = decode_message(data)
+        if msg is None:
+            return []
+        action, room_name = msg.get('action'), msg.get('room_name')
+        if action == 'list_rooms':
+            return range(shard_count)
+        if action in ('join_room', 'create_room', 'close_room') and isinstance(room_name, str):
+            target = self.owners.get(room_name)
+            if target is None and action == 'create_room':
+                # a new room goes to the worker with the fewest rooms
+                load   = collections.Counter(self.owners.values())
+                target = min(range(len(self.inboxes)), key=lambda i: (load[i], i))
+                self.owners[room_name] = target
+                self.creating.add(room_name)
+            elif target is None:
+                target = 0 if worker is None else worker   # no such room: a worker answers with the error
+            if action == 'join_room' and worker is None:
+                self.route(addr, target)   # a first join; moves wait for worker_event
+            return [target]
+        return [] if worker is None else [worker]
+
+    def route(self, addr, worker):
+        self.routes.pop(addr, None)
+        while len(self.routes) >= MAX_TRACKED_ADDRESSES:
+            del self.routes[next(iter(self.routes))]   # forget the oldest join
+        self.routes[addr] = worker
+
+    def worker_event(self, worker):
+        """
+        Read the notifications worker 'worker' sent (see notify_front).
+        """
+        while True:
+            try:
+                event = json.loads(self.inboxes[worker].recv(MAX_DATAGRAM_SIZE))
+            except (BlockingIOError, InterruptedError):
+                return
+            if event['event'] == 'joined':
+                addr = tuple(event['address'])
+                old  = self.routes.get(addr)
+                if old is not None and old != worker:
+                    # the player moved to another worker's room: leave the old one there
+                    self.forward(old, addr, json.dumps({
+                        'action': 'leave', 'player_id': event['player_id']}).encode('utf-8'))
+                if old != worker:
+                    self.route(addr, worker)
+            elif event['event'] == 'room_created':
+                self.creating.discard(event['room'])
+            elif event['event'] in ('create_failed', 'room_closed'):
+                room_name = event['room']
+                if self.owners.get(room_name) == worker \
+                        and (event['event'] == 'room_closed' or room_name in self.creating):
+                    del self.owners[room_name]
+                    self.creating.discard(room_name)
+
+
+# -----------------------------------------------------------------
+# Match recording and replay. With --record FILE everything that can
+# change the game state is appended to FILE as length-prefixed binary
+# records: accepted datagrams, ticks, broadcast steps, pings, timeouts
+# and room cleanups, each with the times the game clock read. A
+# recording continues in FILE.1, FILE.2, ... every RECORD_SEGMENT_BYTES.
+# 'server.py --replay FILE' feeds it back through accept_message and
+# run_tick without sockets, as fast as it can, and checks the state
+# digest written at the end of each segment.
+# -----------------------------------------------------------------
+RECORD_MAGIC      = b'TKREC1\n'          # start of every segment
+RECORD_HEADER     = struct.Struct('<IB')  # body length, record kind
+RECORD_TIMES      = struct.Struct('<dd')  # wall clock, monotonic clock
+RECORD_TICK_TIMES = struct.Struct('<Qdd') # tick number, wall clock, monotonic clock
+
+RECORD_START     = 1   # JSON: segment number, rng seed, tick, tick rate, shard
+RECORD_DATAGRAM  = 2   # times, then the framed address and datagram (see pack_frame)
+RECORD_TICK      = 3   # tick times
+RECORD_BROADCAST = 4   # times; broadcast_rooms ran
+RECORD_PING      = 5   # times, then the framed address
+RECORD_TIMEOUT   = 6   # times, then the framed address
+RECORD_CLOSE     = 7   # times, then the name of the room closed for being empty
+RECORD_DIGEST    = 8   # JSON: tick and state digest, at the end of a segment
+
+recorder = {
+    'file': None,      # open segment; None when not recording
+    'path': None,      # first segment; later ones get a .N suffix
+    'segment': 0,
+    'size': 0,         # bytes written to the open segment
+    'seed': None,      # rng seed of the recorded run
+}
+
+
+def record_event(kind, body):
+    """
+    Append one record to the open segment (buffered; cheap on the hot path).
+    """
+    recorder['file'].write(RECORD_HEADER.pack(len(body), kind) + body)
+    recorder['size'] += RECORD_HEADER.size + len(body)
+
+
+def segment_path(path, segment):
+    return path if segment == 0 else '%s.%d' % (path, segment)
+
+
+def start_recording(path):
+    """
+    Seed the rng and start writing a recording to 'path'.
+    """
+    recorder['seed'] = random.randrange(2 ** 63)
+    rng.seed(recorder['seed'])
+    recorder['path']    = path
+    recorder['segment'] = 0
+    open_segment()
+    log_event('recording', path=path, seed=recorder['seed'])
+
+
+def open_segment():
+    recorder['file'] = open(segment_path(recorder['path'], recorder['segment']), 'wb',
+                            buffering=RECORD_BUFFER_BYTES)
+    recorder['file'].write(RECORD_MAGIC)
+    recorder['size'] = len(RECORD_MAGIC)
+    record_event(RECORD_START, json.dumps({
+        'segment': recorder['segment'],
+        'seed': recorder['seed'],
+        'tick': current_tick,
+        'tick_rate': TICK_RATE,
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+    }).encode('utf-8'))
+
+
+def close_segment():
+    record_event(RECORD_DIGEST, json.dumps({'tick': current_tick, 'digest': state_digest()}).encode('utf-8'))
+    recorder['file'].close()
+    recorder['file'] = None
+
+
+def rotate_recording():
+    """
+    Continue the recording in a new segment; stop after RECORD_MAX_SEGMENTS.
+    """
+    close_segment()
+    recorder['segment'] += 1
+    if recorder['segment'] >= RECORD_MAX_SEGMENTS:
+        log_event('recording_stopped', 'warning', path=recorder['path'], segments=recorder['segment'])
+        return
+    open_segment()
+
+
+def stop_recording():
+    if recorder['file'] is not None:
+        close_segment()
+
+
+def state_digest():
+    """
+    Checksum of the state a replay must reproduce: the tick number and
+    every room's lobby, tanks and bullets (not timers, counters, or
+    delta and engine bookkeeping).
+    """
+    state = [current_tick]
+    for name in sorted(rooms):
+        room = rooms[name]
+        state.append([
+            name, room['num'], room['game_started'], room['waiting_room'], room['next_bullet_id'],
+            sorted([pid, list(p['address'][:2]), p['ready'], p['position'], p['direction'], p['hp'],
+                    p['skin'], p.get('moving'), p.get('move_seq'), p.get('input_seq')]
+                   for pid, p in room['players'].items()),
+            [[b[field] for field in PUBLIC_BULLET_FIELDS] + [b['rewind']] for b in room['bullets']],
+        ])
+    return '%08x' % zlib.crc32(json.dumps(state).encode('utf-8'))
+
+
+def read_recording(path):
+    """
+    Yield (kind, body) for every record of a recording, segment by
+    segment. A record cut off by a crash ends its segment.
+    """
+    segment = 0
+    while os.path.exists(segment_path(path, segment)):
+        with open(segment_path(path, segment), 'rb') as f:
+            data = f.read()
+        if not data.startswith(RECORD_MAGIC):
+            raise ValueError('%s is not a recording' % segment_path(path, segment))
+        offset = len(RECORD_MAGIC)
+        while offset + RECORD_HEADER.size <= len(data):
+            length, kind = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > len(data):
+                break
+            yield kind, data[offset:offset + length]
+            offset += length
+        segment += 1
+
+
+class ReplayTransport:
+    """
+    Stand-in for the UDP transport during a replay: counts what would
+    have been sent.
+    """
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes     = 0
+
+    def sendto(self, data, addr):
+        self.datagrams += 1
+        self.bytes     += len(data)
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def replay_recording(path):
+    """
+    Run a recording through the game logic in this (fresh) process and
+    compare the state digests. Returns a summary of the run.
+    """
+    transport     = ReplayTransport()
+    step          = 1.0 / TICK_RATE
+    refresh_every = max(1, round(STATE_REFRESH_INTERVAL * TICK_RATE))
+    counts     = collections.Counter()
+    mismatches = []
+    started    = time.perf_counter()
+    for kind, body in read_recording(path):
+        counts[kind] += 1
+        if kind == RECORD_DATAGRAM:
+            wall, mono = RECORD_TIMES.unpack_from(body)
+            addr, data = unpack_frame(body[RECORD_TIMES.size:])
+            msg = parse_message(data)
+            clock.pin(wall, mono)
+            allow_datagram(addr, msg['action'], mono)   # same buckets as live, for bundled inputs
+            accept_message(transport, addr, msg, mono)
+        elif kind == RECORD_TICK:
+            _, wall, mono = RECORD_TICK_TIMES.unpack(body)
+            clock.pin(wall, mono)
+            run_tick(transport, wall, step)
+        elif kind == RECORD_BROADCAST:
+            clock.pin(*RECORD_TIMES.unpack(body))
+            broadcast_rooms(transport, refresh_every)
+            flush_egress()
+        elif kind in (RECORD_PING, RECORD_TIMEOUT):
+            wall, mono = RECORD_TIMES.unpack_from(body)
+            addr, _    = unpack_frame(body[RECORD_TIMES.size:])
+            clock.pin(wall, mono)
+            if kind == RECORD_PING:
+                sessions[addr]['ping_sent'] = mono
+            else:
+                expire_session(addr)
+        elif kind == RECORD_CLOSE:
+            clock.pin(*RECORD_TIMES.unpack_from(body))
+            close_room(transport, body[RECORD_TIMES.size:].decode('utf-8'), 'empty')
+        elif kind == RECORD_START:
+            start = json.loads(body)
+            if start['tick_rate'] != TICK_RATE:
+                raise ValueError('recorded at TICK_RATE %s, this server runs at %s' % (start['tick_rate'], TICK_RATE))
+            if start['segment'] == 0:
+                rng.seed(start['seed'])
+                if start['shard_count'] > 1:
+                    join_shard(start['shard_index'], start['shard_count'])
+        elif kind == RECORD_DIGEST:
+            expected = json.loads(body)
+            digest   = state_digest()
+            if (expected['tick'], expected['digest']) != (current_tick, digest):
+                mismatches.append({'tick': current_tick, 'expected': expected, 'digest': digest})
+    flush_egress()
+    clock.unpin()
+    elapsed = time.perf_counter() - started
+    return {
+        'event': 'replay_finished',
+        'ticks': counts[RECORD_TICK],
+        'datagrams': counts[RECORD_DATAGRAM],
+        'seconds': round(elapsed, 3),
+        'ticks_per_s': round(counts[RECORD_TICK] / elapsed, 1) if elapsed else None,
+        'datagrams_per_s': round(counts[RECORD_DATAGRAM] / elapsed, 1) if elapsed else None,
+        'sent': {'datagrams': transport.datagrams, 'bytes': transport.bytes},
+        'digests_checked': counts[RECORD_DIGEST],
+        'mismatches': mismatches,
+        'digest': state_digest(),
+    }
+
+
+# -----------------------------------------------------------------
+# Hot restart (kill -HUP <pid>, single process only). The server starts
+# a copy of itself with --takeover. Once the copy is loaded, the old
+# process stops reading, pickles the game state and passes it over a
+# Unix socket together with the UDP socket itself (SCM_RIGHTS).
+# Datagrams that arrive meanwhile wait in the socket's buffer. The new
+# process restores the state and carries on ticking; the old one exits.
+# -----------------------------------------------------------------
+RESTART_HEADER = struct.Struct('<Q')   # length of the pickled state that follows the socket
+restart = {'child': None, 'channel': None}   # the restart in progress
+
+
+def save_state(recording):
+    """
+    Everything the new process needs to carry on every match, pickled.
+    """
+    for room in rooms.values():
+        room['bullet_arrays'] = None   # rebuilt when needed
+    return pickle.dumps({
+        'rooms': rooms,
+        'active_rooms': active_rooms,
+        'room_wakeups': room_wakeups,
+        'room_nums': next(room_nums),
+        'player_rooms': player_rooms,
+        'sessions': sessions,
+        'heartbeat_wheel': heartbeat_wheel,
+        'heartbeat_slots': next(heartbeat_slots),
+        'player_nums': player_nums,
+        'players_by_num': players_by_num,
+        'next_player_num': next_player_num,
+        'current_tick': current_tick,
+        'rate_buckets': rate_buckets,
+        'rng': rng.getstate(),
+        'recorder': {key: recorder[key] for key in ('path', 'segment', 'seed')} if recording else None,
+    }, pickle.HIGHEST_PROTOCOL)
+
+
+def load_state(data):
+    """
+    Replace this process's (empty) state with a save_state snapshot. A
+    recording continues in the next segment.
+    """
+    global rooms, active_rooms, room_wakeups, room_nums, player_rooms, sessions, heartbeat_wheel
+    global heartbeat_slots, player_nums, players_by_num, next_player_num, current_tick, rate_buckets
+    state = pickle.loads(data)
+    rooms           = state['rooms']
+    active_rooms    = state['active_rooms']
+    room_wakeups    = state['room_wakeups']
+    room_nums       = itertools.count(state['room_nums'])
+    player_rooms    = state['player_rooms']
+    sessions        = state['sessions']
+    heartbeat_wheel = state['heartbeat_wheel']
+    heartbeat_slots = itertools.count(state['heartbeat_slots'])
+    player_nums     = state['player_nums']
+    players_by_num  = state['players_by_num']
+    next_player_num = state['next_player_num']
+    current_tick    = state['current_tick']
+    rate_buckets    = state['rate_buckets']
+    rng.setstate(state['rng'])
+    if state['recorder']:
+        recorder.update(state['recorder'])
+        if recorder['segment'] < RECORD_MAX_SEGMENTS:
+            open_segment()
+
+
+def start_restart(transport):
+    """
+    SIGHUP: start the new server process; hand_off runs once it is ready.
+    """
+    if shard_count > 1:
+        log_event('restart_unsupported', 'warning', reason='not with --workers')
+        return
+    if restart['child'] is not None:
+        return   # one restart at a time
+    args = sys.argv[1:]
+    if '--takeover' in args:
+        i = args.index('--takeover')
+        del args[i:i + 2]
+    channel, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    restart['child'] = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + args + ['--takeover', str(child_end.fileno())],
+        pass_fds=[child_end.fileno()])
+    restart['channel'] = channel
+    child_end.close()
+    asyncio.get_running_loop().add_reader(channel, hand_off, transport)
+    log_event('restart_started', child=restart['child'].pid)
+
+
+def hand_off(transport):
+    """
+    The new process is ready: stop reading, send it the UDP socket and
+    the state, and exit once it confirms. Without a confirmation within
+    RESTART_TIMEOUT the new process is killed and this one carries on.
+    Nothing else runs on the event loop in the meantime.
+    """
+    channel, child = restart['channel'], restart['child']
+    asyncio.get_running_loop().remove_reader(channel)
+    if channel.recv(1) != b'R':
+        abort_restart('new process exited before it was ready')
+        return
+    started = time.perf_counter()
+    transport.pause_reading()   # from here on datagrams wait for the new process
+    flush_egress()
+    recording = recorder['file'] is not None
+    if recording:
+        close_segment()
+        recorder['segment'] += 1   # the new process records the next segment
+    data = save_state(recording)
+    try:
+        channel.settimeout(RESTART_TIMEOUT)
+        socket.send_fds(channel, [RESTART_HEADER.pack(len(data))], [transport.get_extra_info('socket').fileno()])
+        channel.sendall(data)
+        confirmed = channel.recv(1) == b'K'
+    except OSError:
+        confirmed = False
+    if not confirmed:
+        abort_restart('new process did not take over')
+        if recording:
+            open_segment()
+        transport.resume_reading()
+        return
+    log_event('restart_handed_off', child=child.pid, state_bytes=len(data),
+              ms=round((time.perf_counter() - started) * 1000, 1))
+    sys.exit(0)
+
+
+def abort_restart(reason):
+    restart['child'].kill()
+    restart['child'].wait()
+    restart['channel'].close()
+    restart['child'] = restart['channel'] = None
+    log_event('restart_failed', 'error', reason=reason)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('old server process went away during the handoff')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+async def take_over(fd):
+    """
+    New process of a hot restart: tell the old process we are ready,
+    receive the UDP socket and the state on channel 'fd', confirm and
+    serve.
+    """
+    loop    = asyncio.get_running_loop()
+    channel = socket.socket(fileno=fd)
+    channel.sendall(b'R')
+    header, fds, _, _ = socket.recv_fds(channel, RESTART_HEADER.size, 1)
+    if len(header) != RESTART_HEADER.size or len(fds) != 1:
+        raise ConnectionError('old server process went away during the handoff')
+    started = time.perf_counter()
+    (size,) = RESTART_HEADER.unpack(header)
+    load_state(recv_exactly(channel, size))
+    udp_sock = socket.socket(fileno=fds[0])
+    udp_sock.setblocking(False)
+    transport, _ = await loop.create_datagram_endpoint(GameServerProtocol, sock=udp_sock)
+    channel.sendall(b'K')
+    channel.close()
+    log_event('restart_resumed', state_bytes=size, ms=round((time.perf_counter() - started) * 1000, 1),
+              rooms=len(rooms), players=len(player_rooms), tick=current_tick)
+    await run_server(transport)
 
 
 # ------------------------
 # Main entry point
 # ------------------------
-async def main():
+async def run_server(transport):
     """
-    Set up UDP server and schedule background tasks.
+    Schedule the background tasks for the rooms of this process and run forever.
     """
     loop = asyncio.get_running_loop()
-    # bind to localhost:9999
-    transport, _ = await loop.create_datagram_endpoint(
-        GameServerProtocol,
-        local_addr=('10.247.1.236', 9999)
-    )
+    # kill -USR1 <pid> writes the whole server state to the log
+    if hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1, dump_state, 'SIGUSR1')
+    # kill -USR2 <pid> writes a PROFILE_SECONDS stack profile
+    if hasattr(signal, 'SIGUSR2'):
+        loop.add_signal_handler(signal.SIGUSR2, start_profiler)
+    # kill -HUP <pid> restarts the server without dropping matches
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, start_restart, transport)
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + 1 + shard_index if shard_count > 1 else METRICS_PORT)
+    if RECORD_PATH and recorder['path'] is None:   # after a hot restart it is already running
+        start_recording(RECORD_PATH if shard_count == 1 else '%s.w%d' % (RECORD_PATH, shard_index))
 
     # start background loops
     asyncio.create_task(game_tick(transport))
     asyncio.create_task(ping_task(transport))
+    asyncio.create_task(room_cleanup_task(transport))
+    asyncio.create_task(loop_lag_task())
 
     # keep server running indefinitely
     await asyncio.Event().wait()
 
 
+async def main(host, port):
+    """
+    Set up UDP server and schedule background tasks.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        GameServerProtocol,
+        local_addr=(host, port)
+    )
+    await run_server(transport)
+
+
+async def watch_parent(parent_pid, stop):
+    """
+    Stop this worker if the front process is gone.
+    """
+    while os.getppid() == parent_pid:
+        await asyncio.sleep(1)
+    stop.set()
+
+
+async def serve_worker(udp_sock, inbox, parent_pid):
+    loop = asyncio.get_running_loop()
+    global front_link
+    transport = SocketSender(udp_sock)
+    await loop.create_datagram_endpoint(lambda: WorkerInboxProtocol(transport), sock=inbox)
+    front_link = inbox
+    log_event('worker_started', rooms=list(rooms))
+    # stop on SIGTERM from the front process, or when it disappears
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    server  = asyncio.create_task(run_server(transport))
+    watcher = asyncio.create_task(watch_parent(parent_pid, stop))
+    await stop.wait()
+    server.cancel()
+    watcher.cancel()
+
+
+async def serve_front(udp_sock, inboxes):
+    loop = asyncio.get_running_loop()
+    _, front = await loop.create_datagram_endpoint(lambda: FrontProtocol(inboxes), sock=udp_sock)
+    for i, inbox in enumerate(inboxes):
+        loop.add_reader(inbox.fileno(), front.worker_event, i)
+    loop.add_signal_handler(signal.SIGHUP, log_event, 'restart_unsupported', 'warning')
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT, front=True)
+    await asyncio.Event().wait()
+
+
+def run_logged(coro):
+    """
+    Run 'coro' with the background log writer, flushing it on the way out.
+    """
+    writer = start_log_writer()
+    try:
+        asyncio.run(coro)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_recording()
+        # let the writer finish what is already queued
+        try:
+            log_queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        writer.join(timeout=5)
+
+
+def run_worker(index, count, udp_sock, inbox, parent_pid):
+    """
+    Worker process entry point: keep only the rooms of shard 'index'.
+    """
+    join_shard(index, count)
+    run_logged(serve_worker(udp_sock, inbox, parent_pid))
+
+
+def join_shard(index, count):
+    """
+    Make this process worker 'index' of 'count': keep only its rooms.
+    """
+    global shard_index, shard_count, next_player_num
+    shard_index, shard_count = index, count
+    next_player_num = index + 1
+    owners = assign_rooms(rooms, count)
+    for name in [name for name in rooms if owners[name] != index]:
+        del rooms[name]
+
+
+def run_sharded(host, port, workers):
+    """
+    Bind the UDP socket, fork one worker per shard, then run the front end.
+    Workers are forked before any event loop or thread exists.
+    """
+    global shard_count
+    shard_count = workers
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.bind((host, port))
+    udp_sock.setblocking(False)
+
+    ctx = multiprocessing.get_context('fork')
+    inboxes, procs = [], []
+    for i in range(workers):
+        front_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        proc = ctx.Process(target=run_worker, args=(i, workers, udp_sock, worker_end, os.getpid()),
+                           daemon=True)
+        proc.start()
+        worker_end.close()
+        front_end.setblocking(False)
+        inboxes.append(front_end)
+        procs.append(proc)
+    try:
+        run_logged(serve_front(udp_sock, inboxes))
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Tetanki game server')
+    parser.add_argument('--host', default='10.247.1.236', help='address to bind')
+    parser.add_argument('--port', type=int, default=9999, help='UDP port to bind')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes to spread rooms over (Linux only when > 1)')
+    parser.add_argument('--stats-interval', type=float, default=TICK_STATS_INTERVAL,
+                        help='seconds between tick_stats log records')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve /metrics on this port of %s (0 = off)' % METRICS_HOST)
+    parser.add_argument('--record', metavar='FILE',
+                        help='record every match to FILE (FILE.wN per worker) for --replay')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay a recording without sockets, check its state and report the speed')
+    parser.add_argument('--takeover', type=int, metavar='FD', help=argparse.SUPPRESS)   # hot restart (SIGHUP)
+    args = parser.parse_args()
+    TICK_STATS_INTERVAL = args.stats_interval
+    METRICS_PORT        = args.metrics_port
+    RECORD_PATH         = args.record
+    if args.replay:
+        LOG_LEVEL = 'warning'
+        summary = replay_recording(args.replay)
+        print(json.dumps(summary))
+        sys.exit(1 if summary['mismatches'] else 0)
+    # exit cleanly on SIGTERM too, so logs are flushed and workers are stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.takeover is not None:
+        run_logged(take_over(args.takeover))
+    elif args.workers > 1:
+        run_sharded(args.host, args.port, args.workers)
+    else:
+        run_logged(main(args.host, args.port))
@@ -0,0 +1,432 @@
+"""
+Compact binary wire format for the game server.
+
+Clients opt in by sending "wire": "binary" in their (JSON) join_room
+message. After that the server sends them binary packets, and they may
+send binary packets back. JSON stays available for everyone else.
+
+Every binary packet starts with a 3-byte header: MAGIC, VERSION and the
+message type. A JSON packet always starts with '{', which is never MAGIC,
+so the server can tell the two apart by the first byte.
+
+Players and rooms are referred to by the small numbers the server hands
+out in join_room_response ('player_num', 'room_num'), positions are
+int16 in 1/POSITION_SCALE pixel units and directions are one-byte enums.
+
+Every client packet carries the player number right after the header.
+An input bundle holds several inputs, each one a sequence number and a
+message type followed by that message's usual body.
+"""
+import struct
+
+MAGIC          = 0xB7
+VERSION        = 1
+POSITION_SCALE = 8          # 1/8 px resolution, +-4096 px range
+
+# -----------------
+# Message type ids
+# -----------------
+# client -> server
+MSG_PONG       = 1
+MSG_ACK        = 2
+MSG_MOVE       = 3
+MSG_SHOOT      = 4
+MSG_SET_READY  = 5
+MSG_START_GAME = 6
+MSG_LEAVE      = 7
+MSG_REVIVE     = 8
+MSG_MOVE_INPUT = 9          # server-side movement
+MSG_BUNDLE     = 10         # input_bundle
+MSG_CHAT       = 11
+# server -> client
+MSG_PING       = 16
+MSG_STATE      = 17         # keyframe or delta, see STATE_* flags
+
+# actions that carry nothing but the player number
+PLAYER_ONLY_ACTIONS = {
+    MSG_PONG:       'pong',
+    MSG_SET_READY:  'set_ready',
+    MSG_START_GAME: 'start_game',
+    MSG_LEAVE:      'leave',
+    MSG_REVIVE:     'revive',
+}
+PLAYER_ONLY_TYPES = {action: t for t, action in PLAYER_ONLY_ACTIONS.items()}
+
+DIRECTIONS      = ('up', 'down', 'left', 'right')
+DIRECTION_CODES = {d: i for i, d in enumerate(DIRECTIONS)}
+NO_DIRECTION    = 0xFF      # move_input without a direction: stop
+
+# optional shoot fields (a shoot with no mask byte at all has none)
+SHOT_TIME      = 0x01
+SHOT_POSITION  = 0x02
+SHOT_DIRECTION = 0x04
+
+# state flags
+STATE_KEYFRAME     = 0x01
+STATE_GAME_STARTED = 0x02   # value of game_started (valid if STATE_HAS_STARTED)
+STATE_HAS_STARTED  = 0x04
+STATE_HAS_WAITING  = 0x08
+
+# per-player field mask
+FIELD_READY     = 0x01
+FIELD_POSITION  = 0x02
+FIELD_DIRECTION = 0x04
+FIELD_HP        = 0x08
+FIELD_SKIN      = 0x10
+FIELD_NAME      = 0x20
+
+EVENT_HIT = 1
+
+HEADER      = struct.Struct('<BBB')        # magic, version, type
+PLAYER_NUM  = struct.Struct('<H')
+ACK         = struct.Struct('<HI')         # player num, seq
+MOVE        = struct.Struct('<hhB')        # x, y, direction
+MOVE_INPUT  = struct.Struct('<IB')         # move seq, direction or NO_DIRECTION
+SEQ         = struct.Struct('<I')
+TIMESTAMP   = struct.Struct('<d')
+BUNDLE_ITEM = struct.Struct('<IB')         # input seq, message type
+STATE       = struct.Struct('<IIdB')       # seq, base seq (0 = keyframe), timestamp, flags
+COUNT       = struct.Struct('<H')
+PLAYER_HEAD = struct.Struct('<HB')         # player num, field mask
+POSITION    = struct.Struct('<hh')
+HP          = struct.Struct('<h')
+BULLET      = struct.Struct('<IHhhBH')     # id, owner num, origin x, origin y, direction, age (ms)
+BULLET_ID   = struct.Struct('<I')
+EVENT       = struct.Struct('<BIHh')       # type, bullet id, player num, hp
+
+
+class WireError(ValueError):
+    """Raised for packets that are not valid binary messages."""
+
+
+def is_binary(data):
+    """True if 'data' looks like a binary packet rather than JSON."""
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+
+def quantize(v):
+    return max(-32768, min(32767, round(v * POSITION_SCALE)))
+
+
+def dequantize(q):
+    return q / POSITION_SCALE
+
+
+# ------------------------
+# Client -> server packets
+# ------------------------
+def encode_client(msg, player_num):
+    """
+    Encode a client message dict (the same shape as the JSON one) for
+    the player with number 'player_num'.
+    """
+    if msg['action'] == 'input_bundle':
+        parts = [HEADER.pack(MAGIC, VERSION, MSG_BUNDLE), PLAYER_NUM.pack(player_num),
+                 COUNT.pack(len(msg['inputs']))]
+        for item in msg['inputs']:
+            kind, body = _encode_body(item)
+            parts.append(BUNDLE_ITEM.pack(item['seq'], kind) + body)
+        return b''.join(parts)
+    kind, body = _encode_body(msg)
+    return HEADER.pack(MAGIC, VERSION, kind) + PLAYER_NUM.pack(player_num) + body
+
+
+def _encode_body(msg):
+    """
+    Message type and body (what follows the player number) of one input.
+    """
+    action = msg['action']
+    if action in PLAYER_ONLY_TYPES:
+        return PLAYER_ONLY_TYPES[action], b''
+    if action == 'ack':
+        return MSG_ACK, SEQ.pack(msg['seq'])
+    if action == 'move':
+        pos = msg['position']
+        return MSG_MOVE, MOVE.pack(quantize(pos['x']), quantize(pos['y']), DIRECTION_CODES[msg['direction']])
+    if action == 'move_input':
+        direction = msg.get('direction')
+        return MSG_MOVE_INPUT, MOVE_INPUT.pack(
+            msg['move_seq'], NO_DIRECTION if direction is None else DIRECTION_CODES[direction])
+    if action == 'shoot':
+        mask, body = 0, []
+        if isinstance(msg.get('state_time'), (int, float)):
+            mask |= SHOT_TIME
+            body.append(TIMESTAMP.pack(msg['state_time']))
+        if msg.get('position'):
+            mask |= SHOT_POSITION
+            body.append(POSITION.pack(quantize(msg['position']['x']), quantize(msg['position']['y'])))
+        if msg.get('direction') in DIRECTION_CODES:
+            mask |= SHOT_DIRECTION
+            body.append(bytes((DIRECTION_CODES[msg['direction']],)))
+        return MSG_SHOOT, bytes((mask,)) + b''.join(body)
+    if action == 'chat':
+        text = str(msg.get('message', '')).encode('utf-8')[:0xFFFF]
+        return MSG_CHAT, COUNT.pack(len(text)) + text
+    raise WireError(f"action {action!r} has no binary encoding")
+
+
+def decode_client(data):
+    """
+    Decode a client packet into a message dict with 'player_num' in
+    place of 'player_id'. Raises WireError on malformed input.
+    """
+    magic, version, kind = _header(data)
+    try:
+        (num,) = PLAYER_NUM.unpack_from(data, HEADER.size)
+        off = HEADER.size + PLAYER_NUM.size
+        if kind == MSG_BUNDLE:
+            (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+            inputs = []
+            for _ in range(n):
+                seq, item_kind = BUNDLE_ITEM.unpack_from(data, off)
+                if item_kind == MSG_BUNDLE:
+                    raise WireError("nested input_bundle")
+                item, off = _decode_body(item_kind, data, off + BUNDLE_ITEM.size)
+                item['seq'] = seq
+                inputs.append(item)
+            return {'action': 'input_bundle', 'player_num': num, 'inputs': inputs}
+        msg, _ = _decode_body(kind, data, off)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise WireError(str(e)) from None
+    msg['player_num'] = num
+    return msg
+
+
+def _decode_body(kind, data, off):
+    """
+    Decode the body of one input at 'off'; returns (message, next offset).
+    """
+    if kind in PLAYER_ONLY_ACTIONS:
+        return {'action': PLAYER_ONLY_ACTIONS[kind]}, off
+    if kind == MSG_ACK:
+        (seq,) = SEQ.unpack_from(data, off)
+        return {'action': 'ack', 'seq': seq}, off + SEQ.size
+    if kind == MSG_MOVE:
+        x, y, d = MOVE.unpack_from(data, off)
+        return {
+            'action': 'move',
+            'position': {'x': dequantize(x), 'y': dequantize(y)},
+            'direction': DIRECTIONS[d],
+        }, off + MOVE.size
+    if kind == MSG_MOVE_INPUT:
+        seq, d = MOVE_INPUT.unpack_from(data, off)
+        msg = {'action': 'move_input', 'move_seq': seq}
+        if d != NO_DIRECTION:
+            msg['direction'] = DIRECTIONS[d]
+        return msg, off + MOVE_INPUT.size
+    if kind == MSG_SHOOT:
+        msg = {'action': 'shoot'}
+        if off == len(data):
+            return msg, off
+        mask, off = data[off], off + 1
+        if mask & SHOT_TIME:
+            (msg['state_time'],) = TIMESTAMP.unpack_from(data, off)
+            off += TIMESTAMP.size
+        if mask & SHOT_POSITION:
+            x, y = POSITION.unpack_from(data, off)
+            msg['position'] = {'x': dequantize(x), 'y': dequantize(y)}
+            off += POSITION.size
+        if mask & SHOT_DIRECTION:
+            msg['direction'] = DIRECTIONS[data[off]]
+            off += 1
+        return msg, off
+    if kind == MSG_CHAT:
+        (length,) = COUNT.unpack_from(data, off)
+        off += COUNT.size
+        if off + length > len(data):
+            raise WireError("chat message cut short")
+        return {'action': 'chat', 'message': data[off:off + length].decode('utf-8')}, off + length
+    raise WireError(f"unknown client message type {kind}")
+
+
+# ------------------------
+# Server -> client packets
+# ------------------------
+def encode_ping():
+    return HEADER.pack(MAGIC, VERSION, MSG_PING)
+
+
+def encode_state(message, player_nums):
+    """
+    Encode an 'update_state' or 'update_delta' message dict built by the
+    server. 'player_nums' maps player_id -> player number.
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, MSG_STATE)]
+    now   = message['timestamp']
+
+    if message['action'] == 'update_state':
+        state    = message['game_state']
+        flags    = STATE_KEYFRAME | STATE_HAS_STARTED | STATE_HAS_WAITING
+        started  = state['game_started']
+        waiting  = state['waiting_room']
+        players  = state['players']
+        removed  = []
+        bullets  = state['bullets']
+        gone     = []
+        base     = 0
+    else:
+        flags    = 0
+        started  = message.get('game_started')
+        waiting  = message.get('waiting_room')
+        players  = message.get('players', {})
+        removed  = message.get('players_removed', [])
+        bullets  = message.get('bullets_added', [])
+        gone     = message.get('bullets_removed', [])
+        base     = message['base']
+        if started is not None:
+            flags |= STATE_HAS_STARTED
+        if waiting is not None:
+            flags |= STATE_HAS_WAITING
+    if started:
+        flags |= STATE_GAME_STARTED
+    parts.append(STATE.pack(message['seq'], base, now, flags))
+
+    parts.append(COUNT.pack(len(players)))
+    for pid, p in players.items():
+        parts.append(_encode_player(pid, p, player_nums[pid], keyframe=flags & STATE_KEYFRAME))
+    parts.append(COUNT.pack(len(removed)))
+    parts.extend(PLAYER_NUM.pack(player_nums.get(pid, 0)) for pid in removed)
+
+    parts.append(COUNT.pack(len(bullets)))
+    for b in bullets:
+        age = max(0, min(0xFFFF, round((now - b['created']) * 1000)))
+        parts.append(BULLET.pack(
+            b['id'], player_nums.get(b['player_id'], 0),
+            quantize(b['origin']['x']), quantize(b['origin']['y']),
+            DIRECTION_CODES.get(b['direction'], DIRECTION_CODES['right']), age))
+    parts.append(COUNT.pack(len(gone)))
+    parts.extend(BULLET_ID.pack(bid) for bid in gone)
+
+    if waiting is not None:
+        parts.append(COUNT.pack(len(waiting)))
+        parts.extend(PLAYER_NUM.pack(player_nums[pid]) for pid in waiting)
+
+    events = message.get('events', [])
+    parts.append(COUNT.pack(len(events)))
+    for e in events:
+        parts.append(EVENT.pack(EVENT_HIT, e['bullet'], player_nums.get(e['player_id'], 0), e['hp']))
+    return b''.join(parts)
+
+
+def _encode_player(pid, p, num, keyframe):
+    mask, body = 0, []
+    if 'ready' in p:
+        mask |= FIELD_READY
+        body.append(bytes((1 if p['ready'] else 0,)))
+    if 'position' in p:
+        mask |= FIELD_POSITION
+        body.append(POSITION.pack(quantize(p['position']['x']), quantize(p['position']['y'])))
+    if 'direction' in p:
+        mask |= FIELD_DIRECTION
+        body.append(bytes((DIRECTION_CODES.get(p['direction'], 0),)))
+    if 'hp' in p:
+        mask |= FIELD_HP
+        body.append(HP.pack(p['hp']))
+    if 'skin' in p:
+        mask |= FIELD_SKIN
+        body.append(bytes((p['skin'],)))
+    # names go with keyframes and with players that are new to the client
+    # (a new player in a delta carries every field)
+    if keyframe or mask == FIELD_READY | FIELD_POSITION | FIELD_DIRECTION | FIELD_HP | FIELD_SKIN:
+        mask |= FIELD_NAME
+        name = pid.encode('utf-8')[:255]
+        body.append(bytes((len(name),)) + name)
+    return PLAYER_HEAD.pack(num, mask) + b''.join(body)
+
+
+def decode_state(data):
+    """
+    Decode a server packet (ping or state) into a message dict. Players
+    and bullet owners are given by number ('player_num'/'owner_num');
+    names come in the 'names' section whenever the server sends them.
+    """
+    magic, version, kind = _header(data)
+    if kind == MSG_PING:
+        return {'action': 'ping'}
+    if kind != MSG_STATE:
+        raise WireError(f"unknown server message type {kind}")
+    try:
+        off = HEADER.size
+        seq, base, now, flags = STATE.unpack_from(data, off)
+        off += STATE.size
+        msg = {'seq': seq, 'timestamp': now, 'keyframe': bool(flags & STATE_KEYFRAME)}
+        if not flags & STATE_KEYFRAME:
+            msg['base'] = base
+        if flags & STATE_HAS_STARTED:
+            msg['game_started'] = bool(flags & STATE_GAME_STARTED)
+
+        players, names = {}, {}
+        (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+        for _ in range(n):
+            num, mask = PLAYER_HEAD.unpack_from(data, off)
+            off += PLAYER_HEAD.size
+            p = {}
+            if mask & FIELD_READY:
+                p['ready'] = bool(data[off])
+                off += 1
+            if mask & FIELD_POSITION:
+                x, y = POSITION.unpack_from(data, off)
+                p['position'] = {'x': dequantize(x), 'y': dequantize(y)}
+                off += POSITION.size
+            if mask & FIELD_DIRECTION:
+                p['direction'] = DIRECTIONS[data[off]]
+                off += 1
+            if mask & FIELD_HP:
+                (p['hp'],) = HP.unpack_from(data, off)
+                off += HP.size
+            if mask & FIELD_SKIN:
+                p['skin'] = data[off]
+                off += 1
+            if mask & FIELD_NAME:
+                length = data[off]
+                names[num] = data[off + 1:off + 1 + length].decode('utf-8')
+                off += 1 + length
+            players[num] = p
+        msg['players'], msg['names'] = players, names
+
+        (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+        msg['players_removed'] = [PLAYER_NUM.unpack_from(data, off + i * PLAYER_NUM.size)[0] for i in range(n)]
+        off += n * PLAYER_NUM.size
+
+        bullets = []
+        (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+        for _ in range(n):
+            bid, owner, x, y, d, age = BULLET.unpack_from(data, off)
+            off += BULLET.size
+            bullets.append({
+                'id': bid,
+                'owner_num': owner,
+                'origin': {'x': dequantize(x), 'y': dequantize(y)},
+                'direction': DIRECTIONS[d],
+                'created': now - age / 1000,
+            })
+        msg['bullets'] = bullets
+
+        (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+        msg['bullets_removed'] = [BULLET_ID.unpack_from(data, off + i * BULLET_ID.size)[0] for i in range(n)]
+        off += n * BULLET_ID.size
+
+        if flags & STATE_HAS_WAITING:
+            (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+            msg['waiting_room'] = [PLAYER_NUM.unpack_from(data, off + i * PLAYER_NUM.size)[0] for i in range(n)]
+            off += n * PLAYER_NUM.size
+
+        events = []
+        (n,), off = COUNT.unpack_from(data, off), off + COUNT.size
+        for _ in range(n):
+            _, bid, num, hp = EVENT.unpack_from(data, off)
+            off += EVENT.size
+            events.append({'type': 'hit', 'bullet': bid, 'player_num': num, 'hp': hp})
+        msg['events'] = events
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise WireError(str(e)) from None
+    return msg
+
+
+def _header(data):
+    if not is_binary(data):
+        raise WireError("not a binary packet")
+    magic, version, kind = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise WireError(f"unsupported wire version {version}")
+    return magic, version, kind